@@ -1,41 +1,144 @@
-from openai import OpenAI
-import openai
-from google import genai
-from google.genai import types
+# SDKs are imported by the chat apps that use them: litellm alone takes
+# seconds to import, and most runs only need one backend or none (dryrun).
 import yaml
 import asyncio
-import fastapi_poe as fp
-from litellm import completion
-from anthropic import Anthropic
+import functools
+import threading
+import time
+from importlib.metadata import entry_points
 
 SYSTEM_PROMPT = "你是一个翻译机器人，将外语翻译为中文。如果内容无需翻译，你会返回原文。你从不增加额外的分析，只返回翻译后的内容。你从来只回答中文。"
-SAFETY_SETTINGS = [
-    types.SafetySetting(
-        category='HARM_CATEGORY_SEXUALLY_EXPLICIT',
-        threshold='BLOCK_NONE'
-    ),
-    types.SafetySetting(
-        category='HARM_CATEGORY_HATE_SPEECH',
-        threshold='BLOCK_NONE'
-    ),
-    types.SafetySetting(
-        category='HARM_CATEGORY_HARASSMENT',
-        threshold='BLOCK_NONE'
-    ),
-    types.SafetySetting(
-        category='HARM_CATEGORY_DANGEROUS_CONTENT',
-        threshold='BLOCK_NONE'
-    )
+SAFETY_CATEGORIES = [
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT',
+    'HARM_CATEGORY_HATE_SPEECH',
+    'HARM_CATEGORY_HARASSMENT',
+    'HARM_CATEGORY_DANGEROUS_CONTENT',
 ]
 
 
+def join_prompt(message, prefix=None):
+    return prefix + "\n" + message if prefix else message
+
+
+@functools.cache
+def safety_settings():
+    from google.genai import types
+    return [types.SafetySetting(category=category, threshold='BLOCK_NONE') for category in SAFETY_CATEGORIES]
+
+
+clients = {}
+clients_lock = threading.Lock()
+# Gemini context caches by (key, model, prefix): (name or None, expiry time)
+context_caches = {}
+context_caches_lock = threading.Lock()
+CONTEXT_CACHE_TTL = 3600
+CONTEXT_CACHE_RENEW = 300  # seconds before expiry a new cache is created
+
+
+def shared_client(factory, **kwargs):
+    """
+    Return one SDK client per factory and arguments. Clients are thread-safe
+    and keep their connection pools, so they are reused across requests and
+    books instead of being created for every chat app.
+    """
+    key = (factory, tuple(sorted(kwargs.items())))
+    with clients_lock:
+        if key not in clients:
+            clients[key] = factory(**kwargs)
+        return clients[key]
+
+
+class ChatResult:
+    """Reply of a chat app with the usage the provider reported, 0 if it did not."""
+
+    def __init__(self, text, input_tokens=0, output_tokens=0, cached_tokens=0, latency=0.0, finish_reason=None):
+        self.text = text
+        self.input_tokens = input_tokens  # including cached tokens
+        self.output_tokens = output_tokens
+        self.cached_tokens = cached_tokens
+        self.latency = latency  # seconds
+        self.finish_reason = finish_reason
+
+    def __str__(self):
+        return self.text
+
+
+def openai_result(response, latency):
+    # Result of an OpenAI-style response, as returned by OpenAI and LiteLLM
+    choice = response.choices[0]
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return ChatResult(
+        choice.message.content,
+        input_tokens=getattr(usage, "prompt_tokens", None) or 0,
+        output_tokens=getattr(usage, "completion_tokens", None) or 0,
+        cached_tokens=getattr(details, "cached_tokens", None) or 0,
+        latency=latency,
+        finish_reason=getattr(choice, "finish_reason", None),
+    )
+
+
 class APITranslationFailure(Exception):
     def __init__(self, message="API connection failed after retries.", *args):
         super().__init__(message, *args)
 
 
+class Capabilities:
+    def __init__(self, is_async=False, streaming=False, batch=False, max_concurrency=None):
+        self.is_async = is_async  # native client is asyncio based
+        self.streaming = streaming  # responses can be streamed
+        self.batch = batch  # provider offers a batch API
+        self.max_concurrency = max_concurrency  # requests in flight the backend handles well, None if unknown
+
+
+# Chat apps by the `backend` name used in translation.yaml. Other packages can
+# add backends through the "ebook_gpt_translator.backends" entry point group.
+BACKENDS = {}
+ENTRY_POINT_GROUP = "ebook_gpt_translator.backends"
+
+
+def register_backend(name, **capabilities):
+    def decorator(cls):
+        cls.capabilities = Capabilities(**capabilities)
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def get_backend(name):
+    if name not in BACKENDS:
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP, name=name):
+            cls = entry_point.load()
+            if not hasattr(cls, "capabilities"):
+                cls.capabilities = Capabilities()
+            BACKENDS[name] = cls
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}. Available: {', '.join(sorted(BACKENDS))}")
+    return BACKENDS[name]
+
+
+def backend_name(name, model):
+    """
+    Backend of a translation.yaml entry: its `backend` field, or for older
+    configs a guess from the entry name.
+    """
+    if 'backend' in model:
+        return model['backend']
+    if 'gemini' in name.lower():
+        return 'google'
+    elif 'poe' in name.lower():
+        return 'poe'
+    elif 'claude' in name.lower():
+        return 'anthropic'
+    elif 'openai' in name.lower():
+        return 'openai'
+    return 'litellm'
+
+
 class APIChatApp:
-    def __init__(self, api_key, model_name, temperature):
+    capabilities = Capabilities()
+
+    def __init__(self, api_key, model_name, temperature=1.0):
         self.api_key = api_key
         self.model_name = model_name
         self.INITIAL_MESSAGE = [
@@ -48,17 +151,29 @@ class APIChatApp:
         self.response = None
         self.temperature = temperature
 
-    def chat(self, message):
+    @classmethod
+    def from_config(cls, model):
+        return cls(api_key=model['key'], model_name=model['name'])
+
+    def chat(self, message, prefix=None):
+        """
+        Send prefix and message as one prompt and return a ChatResult. The
+        prefix is the same across requests, so backends put it where the
+        provider can cache it.
+        """
         raise NotImplementedError("Subclasses must implement this method")
 
 
+@register_backend("openai", streaming=True, batch=True)
 class OpenAIChatApp(APIChatApp):
     def __init__(self, api_key, model_name, temperature=0.7, endpoint="https://api.openai.com/v1"):
         super().__init__(api_key, model_name, temperature)
+        from openai import OpenAI
         if "gpt" in model_name:
             endpoint = "https://api.openai.com/v1"
         # print(base_url)
-        self.client = OpenAI(
+        self.client = shared_client(
+            OpenAI,
             api_key=api_key,
             base_url=endpoint
         )
@@ -70,14 +185,22 @@ class OpenAIChatApp(APIChatApp):
             }
         ]
 
-    def chat(self, message):
+    @classmethod
+    def from_config(cls, model):
+        return cls(api_key=model['key'], model_name=model['name'], endpoint=model['endpoint'])
+
+    def chat(self, message, prefix=None):
+        import openai
+        # The system message and prefix lead the prompt, so servers with
+        # automatic prefix caching (OpenAI, vLLM, llama.cpp) reuse them
         self.messages.append(
             {
                 "role": "user", 
-                "content": message
+                "content": join_prompt(message, prefix)
             }
         )
         try:
+            start = time.monotonic()
             response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=self.messages,
@@ -87,39 +210,118 @@ class OpenAIChatApp(APIChatApp):
             )
             self.messages = [{"role": "assistant", "content": response.choices[0].message.content}]
             self.response = response
-            return response.choices[0].message.content
+            return openai_result(response, time.monotonic() - start)
         except openai.APIError as e:
             raise APITranslationFailure(f"OpenAI API connection failed: {str(e)}")
 
 
+@register_backend("local", streaming=True, max_concurrency=32)
+class LocalChatApp(OpenAIChatApp):
+    """OpenAI-compatible server such as vLLM or llama.cpp, serving many requests at once."""
+
+    def __init__(self, api_key, model_name, temperature=0.7, endpoint="http://localhost:8000/v1"):
+        APIChatApp.__init__(self, api_key, model_name, temperature)
+        from openai import OpenAI
+        self.client = shared_client(OpenAI, api_key=api_key or "EMPTY", base_url=endpoint)
+        self.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+
+    @classmethod
+    def from_config(cls, model):
+        return cls(api_key=model.get('key'), model_name=model['name'],
+                   endpoint=model.get('endpoint', "http://localhost:8000/v1"))
+
+
+@register_backend("litellm")
 class LiteLLMChatApp(APIChatApp):
     def __init__(self, api_key, model_name, temperature=1.0):
         super().__init__(api_key, model_name, temperature)
         
-    def chat(self, message):
-        self.messages.append({"role": "user", "content": message})
+    def chat(self, message, prefix=None):
+        from litellm import completion
+        if prefix and "claude" in self.model_name.lower():
+            # Anthropic models only cache up to an explicit breakpoint
+            content = [
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": message},
+            ]
+        else:
+            content = join_prompt(message, prefix)
+        self.messages.append({"role": "user", "content": content})
         try:
+            start = time.monotonic()
             response = completion(
                 messages=self.messages, model=self.model_name, 
                 api_key=self.api_key, temperature=self.temperature,
-                **({"safety_settings": SAFETY_SETTINGS} if "gemini" in self.model_name.lower() else {})
+                **({"safety_settings": safety_settings()} if "gemini" in self.model_name.lower() else {})
             )
-            response = response.choices[0].message.content
-            self.messages += [{"role": "assistant", "content": response}]
-            return response
+            result = openai_result(response, time.monotonic() - start)
+            self.messages += [{"role": "assistant", "content": result.text}]
+            return result
         except Exception as e:
             raise APITranslationFailure(f"LiteLLM API connection failed: {str(e)}")
 
 
+@register_backend("google", streaming=True, batch=True)
 class GoogleChatApp(APIChatApp):
     def __init__(self, api_key, model_name, temperature=1.0):
         super().__init__(api_key, model_name, temperature)
-        self.client = genai.Client(api_key=self.api_key)
-        
-    def chat(self, message, image=None):
+        from google import genai
+        self.client = shared_client(genai.Client, api_key=self.api_key)
+
+    def context_cache(self, prefix):
+        """
+        Name of a context cache holding the system prompt and prefix, created
+        per model and prefix and renewed shortly before it expires, or None if
+        the model or the prompt size does not allow one (the prefix is then
+        sent inline and may still hit Gemini's implicit cache).
+        """
+        from google.genai import types
+        key = (self.api_key, self.model_name, prefix)
+        with context_caches_lock:
+            name, expiry = context_caches.get(key, (None, 0))
+            if time.time() >= expiry - CONTEXT_CACHE_RENEW:
+                try:
+                    cache = self.client.caches.create(
+                        model=self.model_name,
+                        config=types.CreateCachedContentConfig(
+                            system_instruction=SYSTEM_PROMPT + "\n\n" + prefix,
+                            ttl=f"{CONTEXT_CACHE_TTL}s",
+                        )
+                    )
+                    context_caches[key] = (cache.name, time.time() + CONTEXT_CACHE_TTL)
+                except Exception as e:
+                    from loguru import logger
+                    logger.debug(f"Context cache not created for {self.model_name}: {e}")
+                    context_caches[key] = (None, float("inf"))
+            return context_caches[key][0]
+
+    def drop_context_cache(self, prefix, name):
+        # Forget a cache that failed, unless another thread already replaced it
+        key = (self.api_key, self.model_name, prefix)
+        with context_caches_lock:
+            if context_caches.get(key, (None, 0))[0] == name:
+                del context_caches[key]
+
+    def chat(self, message, prefix=None, image=None):
         if image:
             self.messages = []
 
+        cache_name = self.context_cache(prefix) if prefix else None
+        if not cache_name:
+            return self.generate(join_prompt(message, prefix), None)
+        try:
+            return self.generate(message, cache_name)
+        except APITranslationFailure as e:
+            if "blocked" in str(e):
+                raise
+            # The cache may have expired or been deleted, send the prefix inline
+            from loguru import logger
+            logger.warning(f"Request with context cache {cache_name} failed, resending without it: {e}")
+            self.drop_context_cache(prefix, cache_name)
+            return self.generate(join_prompt(message, prefix), None)
+
+    def generate(self, message, cache_name):
+        from google.genai import types
         try:
             contents = []
             for msg in self.messages:
@@ -146,13 +348,15 @@ class GoogleChatApp(APIChatApp):
                 parts=[types.Part.from_text(message)]
             ))
 
+            start = time.monotonic()
             response = self.client.models.generate_content(
                 model=self.model_name,
                 contents=contents,
                 config=types.GenerateContentConfig(
-                    safety_settings=SAFETY_SETTINGS,
+                    safety_settings=safety_settings(),
                     temperature=self.temperature,
-                    max_output_tokens=8192
+                    max_output_tokens=8192,
+                    cached_content=cache_name
                 )
             )
             
@@ -162,28 +366,45 @@ class GoogleChatApp(APIChatApp):
             
             from loguru import logger
             logger.critical(response)
+
+            latency = time.monotonic() - start
             
             self.messages.append({
                 "role": "assistant",
                 "content": response.text
             })
-            
-            return response.text
+
+            usage = response.usage_metadata
+            candidates = response.candidates or []
+            finish_reason = candidates[0].finish_reason if candidates else None
+            return ChatResult(
+                response.text,
+                input_tokens=getattr(usage, "prompt_token_count", None) or 0,
+                output_tokens=getattr(usage, "candidates_token_count", None) or 0,
+                cached_tokens=getattr(usage, "cached_content_token_count", None) or 0,
+                latency=latency,
+                finish_reason=getattr(finish_reason, "name", finish_reason),
+            )
 
         except Exception as e:
             raise APITranslationFailure(f"Google API connection failed: {str(e)}")
 
 
-class PoeAPIChatApp:
+@register_backend("poe", is_async=True, streaming=True)
+class PoeAPIChatApp(APIChatApp):
     def __init__(self, api_key, model_name):
         self.api_key = api_key
         self.model_name = model_name
         self.messages = []
         
-    def chat(self, message):
-        return asyncio.run(self._async_chat(message))
+    def chat(self, message, prefix=None):
+        # Poe has no prompt caching and reports no usage
+        start = time.monotonic()
+        text = asyncio.run(self._async_chat(join_prompt(message, prefix)))
+        return ChatResult(text, latency=time.monotonic() - start)
     
     async def _async_chat(self, message):
+        import fastapi_poe as fp
         self.messages.append({"role": "user", "content": message})
         final_message = ""
         try:
@@ -195,31 +416,59 @@ class PoeAPIChatApp:
         return final_message
 
 
+@register_backend("anthropic", streaming=True, batch=True)
 class AnthropicChatApp(APIChatApp):
     def __init__(self, api_key, model_name, temperature=1.0):
         super().__init__(api_key, model_name, temperature)
-        self.client = Anthropic(api_key=self.api_key)
+        from anthropic import Anthropic
+        self.client = shared_client(Anthropic, api_key=self.api_key)
         self.system_prompt = SYSTEM_PROMPT
         self.messages = []
 
-    def chat(self, message):
-        self.messages.append({"role": "user", "content": message})
+    def chat(self, message, prefix=None):
+        if prefix:
+            # Cache breakpoint after the prefix: system prompt and prefix are
+            # read from the cache once they exceed the minimum cacheable length
+            content = [
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": message},
+            ]
+        else:
+            content = message
+        self.messages.append({"role": "user", "content": content})
         self.messages.insert(0, {"role": "user", "content": self.system_prompt})
         try:
+            start = time.monotonic()
             response = self.client.messages.create(
                 model=self.model_name,
                 messages=self.messages,
                 system=self.system_prompt,
-                max_tokens=1000,
+                max_tokens=4096,
                 temperature=self.temperature
             )
+            latency = time.monotonic() - start
             assistant_message = response.content[0].text
             self.messages.append({"role": "assistant", "content": assistant_message})
-            return assistant_message
+            usage = response.usage
+            cached = usage.cache_read_input_tokens or 0
+            return ChatResult(
+                assistant_message,
+                # input_tokens excludes tokens read from or written to the cache
+                input_tokens=usage.input_tokens + cached + (usage.cache_creation_input_tokens or 0),
+                output_tokens=usage.output_tokens,
+                cached_tokens=cached,
+                latency=latency,
+                finish_reason=response.stop_reason,
+            )
         except Exception as e:
             raise APITranslationFailure(f"Anthropic API connection failed: {str(e)}")
 
 
+def create_chat_app(name, model):
+    """Create the chat app for a translation.yaml entry."""
+    return get_backend(backend_name(name, model)).from_config(model)
+
+
 if __name__ == "__main__":
     # Example usage:
     with open("translation.yaml", "r") as f:
@@ -248,4 +497,4 @@ if __name__ == "__main__":
     #     endpoint=translation_config['Sakura-OpenAI-api']['endpoint']
     # )
     print(poe_chat.model_name)
-    print(poe_chat.chat("翻译以下外文为中文：Hello, how are you today?"))
+    print(poe_chat.chat("翻译以下外文为中文：Hello, how are you today?").text)
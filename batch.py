@@ -0,0 +1,122 @@
+from translate import book_config, get_config, get_executor
+from translate import set_deadline, deadline_reached, exit_if_deadline_reached
+from utils import load_config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from loguru import logger
+import argparse
+import contextvars
+import glob
+import os
+import yaml
+import docxloader
+import epubloader
+import srtloader
+import txtloader
+
+
+LOADERS = {
+    "epub": epubloader.run,
+    "docx": docxloader.run,
+    "txt": txtloader.run,
+    "srt": srtloader.run,
+    "vtt": srtloader.run,
+}
+
+
+def infer_format(cn_title):
+    for path in sorted(glob.glob(f"output/{cn_title}/input.*")):
+        ext = os.path.splitext(path)[1][1:].lower()
+        if ext in LOADERS:
+            return ext
+    raise FileNotFoundError(f"No input file found in output/{cn_title}/")
+
+
+def load_manifest(path, defaults):
+    """
+    Read a YAML manifest listing the books to translate, e.g.
+
+        - cn_title: 中文书名
+          jp_title: 原书名
+          format: epub        # optional, inferred from output/{cn_title}/input.*
+          prompt: ...         # optional, per-book prompt
+
+    Any other key is copied into the book's config in upper case, on top of
+    the defaults from .env.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        entries = yaml.safe_load(f)
+    books = []
+    for entry in entries:
+        config = dict(defaults)
+        fmt = None
+        for key, value in entry.items():
+            if key.lower() == "format":
+                fmt = str(value).lower()
+            else:
+                config[key.upper()] = str(value)
+        if "CN_TITLE" not in config:
+            raise ValueError(f"Book without cn_title in {path}: {entry}")
+        books.append((config, fmt or infer_format(config["CN_TITLE"])))
+    return books
+
+
+def run_book(config, fmt, args):
+    if deadline_reached():
+        logger.warning(f"Out of time, {config['CN_TITLE']} is left for the next run")
+        return
+    book_config.set(config)
+    sink = logger.add(
+        f"output/{config['CN_TITLE']}/info.log",
+        level="DEBUG",
+        filter=lambda record: get_config() is config,
+    )
+    try:
+        logger.info(f"Translating {config['CN_TITLE']} ({fmt})")
+        LOADERS[fmt](config, argparse.Namespace(dryrun=args.dryrun, polish=False, workers=args.workers))
+    finally:
+        logger.remove(sink)
+
+
+def main():
+    defaults = load_config(missing_ok=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest", help="YAML list of books to translate")
+    parser.add_argument("--dryrun", action="store_true")
+    parser.add_argument("--workers", type=int,
+                        help="API requests in flight, shared by all books. "
+                             "By default WORKERS or the backend's max_concurrency")
+    parser.add_argument("--books", type=int, default=2, help="Books processed at the same time")
+    parser.add_argument("--deadline", type=float,
+                        help="Minutes this run may take. Stops sending requests in time to write partial outputs")
+    args = parser.parse_args()
+
+    if args.dryrun:
+        logger.warning("Dry run mode enabled. No translation will be performed.")
+
+    books = load_manifest(args.manifest, defaults)
+    # Size the shared pool before any loader asks for it
+    get_executor(args.workers)
+    set_deadline(args.deadline)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.books) as executor:
+        # Each book runs in its own context so its book_config stays private
+        futures = {
+            executor.submit(contextvars.copy_context().run, run_book, config, fmt, args): config['CN_TITLE']
+            for config, fmt in books
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                logger.info(f"Finished {futures[future]}")
+            except Exception as e:
+                logger.exception(f"Failed {futures[future]}: {e}")
+                failed.append(futures[future])
+
+    if failed:
+        logger.error(f"{len(failed)}/{len(books)} books failed: {', '.join(failed)}")
+    exit_if_deadline_reached()
+
+
+if __name__ == "__main__":
+    main()
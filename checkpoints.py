@@ -0,0 +1,43 @@
+import json
+import os
+import threading
+import time
+
+
+# Loaders append progress events to output/{CN_TITLE}/.checkpoints and
+# monitor.py uploads when they arrive, instead of on a fixed timer.
+CHECKPOINT_NAME = ".checkpoints"
+lock = threading.Lock()
+
+
+def emit(folder, event, **fields):
+    """
+    Append an event: "chapter" when a chapter or subtitle file is finished,
+    "rows" when new rows reached a cache database, "done" when the outputs
+    are written.
+    """
+    line = json.dumps({"time": time.time(), "event": event, **fields}, ensure_ascii=False)
+    with lock, open(os.path.join(folder, CHECKPOINT_NAME), "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+class CheckpointReader:
+    """Return the events appended since the last read."""
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, CHECKPOINT_NAME)
+        # Earlier events are covered by the sync at startup
+        self.offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        if os.path.getsize(self.path) < self.offset:
+            self.offset = 0  # file was replaced
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Leave a line that is still being written for the next read
+        data = data[:data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        return [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
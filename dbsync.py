@@ -0,0 +1,166 @@
+import glob
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+
+
+# Translation caches (SqlWrapper databases) are not uploaded as live files.
+# The bucket holds a consistent snapshot taken with the SQLite backup API,
+# {name}.db, plus changeset segments with the rows added or changed since,
+# {name}.db.changes/{seq}.json.gz. The snapshot records the last segment it
+# already contains, and download.py replays the newer ones.
+#
+# The monitor keeps the state it last shipped in .sync/{name}.db, so the
+# next segment is the difference between that and a fresh snapshot.
+
+SYNC_DIR = ".sync"
+CHANGES_SUFFIX = ".changes"
+COMPACT_SEGMENTS = 100  # upload a new snapshot after this many segments
+COMPACT_RATIO = 0.5  # or once segments add up to half the snapshot size
+
+
+def is_database(path):
+    return path.endswith(".db")
+
+
+def snapshot(db_path, snapshot_path):
+    # Copy a database that may be written to through the online backup API
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(snapshot_path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def read_state(db_path):
+    """Return (last segment included, last segment in the snapshot, bytes of segments since)."""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS sync_state (seq INTEGER, base_seq INTEGER, segment_bytes INTEGER)')
+        row = conn.execute('SELECT seq, base_seq, segment_bytes FROM sync_state').fetchone()
+        return row or (0, 0, 0)
+    finally:
+        conn.close()
+
+
+def write_state(db_path, seq, base_seq, segment_bytes):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS sync_state (seq INTEGER, base_seq INTEGER, segment_bytes INTEGER)')
+        conn.execute('DELETE FROM sync_state')
+        conn.execute('INSERT INTO sync_state VALUES (?, ?, ?)', (seq, base_seq, segment_bytes))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def diff(old_path, new_path):
+    """Return (rows to upsert, keys to delete) turning old into new."""
+    conn = sqlite3.connect(new_path)
+    try:
+        conn.execute('ATTACH DATABASE ? AS old', (old_path,))
+        upserts = conn.execute('SELECT key, value FROM data EXCEPT SELECT key, value FROM old.data').fetchall()
+        deletes = [row[0] for row in conn.execute('SELECT key FROM old.data EXCEPT SELECT key FROM data')]
+        return upserts, deletes
+    finally:
+        conn.close()
+
+
+def write_segment(path, upserts, deletes):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump({"upserts": upserts, "deletes": deletes}, f, ensure_ascii=False)
+
+
+def apply_segment(db_path, path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        segment = json.load(f)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT)')
+        conn.executemany('INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)', segment["upserts"])
+        conn.executemany('DELETE FROM data WHERE key=?', [(key,) for key in segment["deletes"]])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def segment_key(s3_path, seq):
+    return f"{s3_path}{CHANGES_SUFFIX}/{seq:08d}.json.gz"
+
+
+def sync_database(s3_client, local_folder, relative_path, bucket_name, s3_path, upload):
+    """
+    Ship the changes of one database: a changeset segment with the rows
+    that differ from the last shipped state, or a full snapshot on the first
+    sync and when the segments have grown large. upload(local_path, s3_path)
+    uploads a file and returns True on success. Returns whether anything
+    was uploaded.
+    """
+    db_path = os.path.join(local_folder, relative_path)
+    state_path = os.path.join(local_folder, SYNC_DIR, relative_path)
+    snapshot_path = state_path + ".snapshot"
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    snapshot(db_path, snapshot_path)
+
+    seq, base_seq, segment_bytes = read_state(state_path) if os.path.exists(state_path) else (0, 0, 0)
+    compact = (
+        not os.path.exists(state_path)
+        or seq - base_seq >= COMPACT_SEGMENTS
+        or segment_bytes > COMPACT_RATIO * os.path.getsize(snapshot_path)
+    )
+
+    if compact:
+        write_state(snapshot_path, seq, seq, 0)
+        if not upload(snapshot_path, s3_path):
+            return False
+        # Segments up to seq are part of the snapshot now
+        stale = [{"Key": segment_key(s3_path, i)} for i in range(base_seq + 1, seq + 1)]
+        for start in range(0, len(stale), 1000):
+            s3_client.delete_objects(Bucket=bucket_name, Delete={"Objects": stale[start:start + 1000]})
+        os.replace(snapshot_path, state_path)
+        return True
+
+    upserts, deletes = diff(state_path, snapshot_path)
+    if not upserts and not deletes:
+        os.remove(snapshot_path)
+        return False
+    segment_path = f"{snapshot_path}.json.gz"
+    write_segment(segment_path, upserts, deletes)
+    size = os.path.getsize(segment_path)
+    uploaded = upload(segment_path, segment_key(s3_path, seq + 1))
+    os.remove(segment_path)
+    if uploaded:
+        write_state(snapshot_path, seq + 1, base_seq, segment_bytes + size)
+        os.replace(snapshot_path, state_path)
+    else:
+        os.remove(snapshot_path)
+    return uploaded
+
+
+def replay_changes(local_folder):
+    """
+    Apply downloaded changeset segments to their databases, remove them, and
+    record the result as the shipped state so the monitor continues from it
+    instead of uploading a new snapshot.
+    """
+    for db_path in glob.glob(os.path.join(local_folder, "**", "*.db"), recursive=True):
+        changes_dir = db_path + CHANGES_SUFFIX
+        seq, base_seq, segment_bytes = read_state(db_path)
+        for path in sorted(glob.glob(os.path.join(changes_dir, "*.json.gz"))):
+            segment_seq = int(os.path.basename(path).split(".")[0])
+            if segment_seq <= seq:
+                continue  # already part of the snapshot
+            apply_segment(db_path, path)
+            print(f"Applied {path}")
+            seq = segment_seq
+            segment_bytes += os.path.getsize(path)
+        write_state(db_path, seq, base_seq, segment_bytes)
+        shutil.rmtree(changes_dir, ignore_errors=True)
+
+        state_path = os.path.join(local_folder, SYNC_DIR, os.path.relpath(db_path, local_folder))
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        shutil.copyfile(db_path, state_path)
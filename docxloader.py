@@ -1,15 +1,18 @@
 from docx import Document
 from docx.text.paragraph import Paragraph
-from translate import translate, validate, SqlWrapper
-from utils import load_config
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from concurrent.futures import as_completed
+from translate import translate, translate_segment, align_translate, validate, SqlWrapper, get_executor, submit, save_report, checkpoint
+from translate import TranslationFailed, set_deadline, exit_if_deadline_reached
+from utils import load_config, passthrough_segments
 from loguru import logger
+from tqdm import tqdm
 import string
 import re
 import argparse
-import os
-
-# Load the configuration
-config = load_config()
 
 
 def is_title(paragraph):
@@ -79,7 +82,7 @@ def get_style(paragraph):
         return None
 
 
-def add_text_to_paragraph(paragraph, new_text, translation_only=False):
+def add_text_to_paragraph(paragraph, new_text, translation_only=False, style=None):
     """
     Add text to a given Paragraph object, using the style and font size of the run
     with the highest character count.
@@ -88,6 +91,8 @@ def add_text_to_paragraph(paragraph, new_text, translation_only=False):
     - paragraph: A docx.text.paragraph.Paragraph object.
     - new_text: The text to add to the paragraph.
     - translation_only: If True, replace the original text instead of appending
+    - style: (get_style(paragraph), is_bold(paragraph)) taken from the original
+      paragraph, in case it was already modified
     """
     if new_text.isdigit():
         return
@@ -97,7 +102,9 @@ def add_text_to_paragraph(paragraph, new_text, translation_only=False):
             "The provided paragraph must be a docx.text.paragraph.Paragraph object."
         )
 
-    result = get_style(paragraph)
+    if style is None:
+        style = (get_style(paragraph), is_bold(paragraph))
+    result, bold = style
 
     if translation_only:
         # Clear existing runs
@@ -105,12 +112,12 @@ def add_text_to_paragraph(paragraph, new_text, translation_only=False):
             run._element.getparent().remove(run._element)
 
     if result:
-        style, font_size = result
+        run_style, font_size = result
         new_run = paragraph.add_run(new_text)
-        new_run.style = style
+        new_run.style = run_style
         if font_size:
             new_run.font.size = font_size
-        if is_bold(paragraph):
+        if bold:
             new_run.bold = True
     else:
         paragraph.add_run(new_text)
@@ -129,113 +136,214 @@ def is_page_number(paragraph):
     return False
 
 
-def process_paragraphs(doc):
+def group_paragraphs(paragraphs):
     """
-    Process paragraphs and return information about which paragraphs to translate
-    and how they're connected.
+    Merge paragraphs that continue the previous one (e.g. lines broken by a
+    PDF conversion) in a single forward pass.
+
+    Returns a list of groups, each a list of paragraph indices in document
+    order. The translation of a group is added to its last paragraph.
     """
+    groups = []
+    current = None
     last_char = ""
     prev_style = None
-    prev_paragraph = None
-    paragraph_maps = {}
-    final_paragraphs = set()
 
-    for i, paragraph in enumerate(doc.paragraphs):
+    for i, paragraph in enumerate(paragraphs):
+        text = paragraph.text.strip()
+        if text == "":
+            continue
         style = get_style(paragraph)
-        if paragraph.text.strip() == "":
+        if is_title(text) or is_page_number(paragraph) or is_bold(paragraph):
+            groups.append([i])
             continue
         elif (
-            is_title(paragraph.text.strip())
-            or is_page_number(paragraph)
-            or is_bold(paragraph)
+            current is not None
+            and (last_char.isalnum() or last_char == ",")
+            and text[0].isalnum()
+            and style == prev_style
         ):
-            final_paragraphs.add(i)
-            continue
-        elif (
-            (last_char.isalnum() or last_char == ",")
-            and (paragraph.text.strip()[0].isalnum())
-        ) and style == prev_style:
-            last_char = paragraph.text.strip()[-1]
-            paragraph_maps[i] = prev_paragraph
-            prev_paragraph = i
+            current.append(i)
         else:
-            last_char = paragraph.text.strip()[-1]
-            prev_style = get_style(paragraph)
-            if prev_paragraph:
-                final_paragraphs.add(prev_paragraph)
-            prev_paragraph = i
-            paragraph_maps[i] = None
+            prev_style = style
+            current = [i]
+            groups.append(current)
+        last_char = text[-1]
+
+    return groups
+
 
-    if prev_paragraph:
-        final_paragraphs.add(prev_paragraph)
+def translate_groups(paragraphs, groups, cache, args):
+    """
+    Translate paragraph groups concurrently.
 
-    return final_paragraphs, paragraph_maps
+    Returns {index of the last paragraph of a group: translated text},
+    without the groups that got no translation. Cache reads and
+    writes stay on the calling thread.
+    """
+    texts = {}
+    for group in groups:
+        text = " ".join(paragraphs[i].text.strip() for i in group)
+        if not text.isdigit():
+            texts[group[-1]] = text
+    # Drop segments that need no translation, they keep their original text
+    passthrough = passthrough_segments(list(texts.values()))
+    texts = {i: text for (i, text), skip in zip(texts.items(), passthrough) if not skip}
+
+    results = {}
+    futures = {}
+    for text in set(texts.values()):
+        if text in cache and validate(text, cache[text]):
+            results[text] = cache[text]
+        else:
+            futures[submit(translate_segment, text, dryrun=args.dryrun)] = text
+    for future in tqdm(as_completed(futures), total=len(futures)):
+        text = futures[future]
+        try:
+            results[text] = future.result()
+        except TranslationFailed:
+            # Rejected or out of time, keep the original for the next run
+            continue
+        if not args.dryrun:
+            cache[text] = results[text]
 
+    return {i: results[text] for i, text in texts.items() if text in results}
 
-def translate_doc(docx_filename, output_filename, args, translation_only=False):
+
+def load_stories(doc):
     """
-    Translate a document and save the output.
+    Collect the XML roots whose paragraphs are translated: the document body,
+    headers, footers, footnotes and endnotes.
+
+    Returns a list of (root element, part) pairs. The part is None for parts
+    python-docx keeps parsed; footnotes and endnotes are plain blobs that are
+    parsed here and written back by save_stories().
+    """
+    stories = [(doc.element.body, None)]
+    for rel in doc.part.rels.values():
+        if rel.is_external:
+            continue
+        if rel.reltype in (RT.HEADER, RT.FOOTER):
+            stories.append((rel.target_part.element, None))
+        elif rel.reltype in (RT.FOOTNOTES, RT.ENDNOTES):
+            stories.append((parse_xml(rel.target_part.blob), rel.target_part))
+    return stories
+
+
+def save_stories(doc, stories, filename):
+    for root, part in stories:
+        if part is not None:
+            part._blob = serialize_part_xml(root)
+    doc.save(filename)
+
+
+def extract_paragraphs(doc, stories):
+    """
+    Walk the XML of every story once and split its paragraphs into body
+    paragraphs, which are merged by group_paragraphs, and short standalone
+    paragraphs: table cells, text boxes, headers, footers and notes.
+    """
+    body = doc.element.body
+    paragraphs, others = [], []
+    for root, _ in stories:
+        for p in root.iter(qn("w:p")):
+            paragraph = Paragraph(p, doc._body)
+            if p.getparent() is body:
+                paragraphs.append(paragraph)
+            else:
+                others.append(paragraph)
+    return paragraphs, others
+
+
+def translate_short_paragraphs(paragraphs, cache, args):
+    """
+    Translate many short paragraphs, like table cells, in numbered batches
+    through align_translate instead of one request per paragraph.
+
+    Returns a list of (paragraph, translated text).
+    """
+    texts = [p.text.strip() for p in paragraphs]
+    targets = [(p, text) for p, text in zip(paragraphs, texts) if text and not text.isdigit()]
+    passthrough = passthrough_segments([text for _, text in targets])
+    targets = [target for target, skip in zip(targets, passthrough) if not skip]
+    if args.dryrun:
+        return [(p, translate(text, dryrun=True)) for p, text in targets]
+
+    pending = [
+        text for text in dict.fromkeys(text for _, text in targets)
+        if not (text in cache and validate(text, cache[text]))
+    ]
+    if pending:
+        align_translate(pending, cache)
+    return [(p, cache[text]) for p, text in targets if text in cache]
+
+
+def translate_doc(docx_filename, output_filename, translated_filename, cache_filename, args):
+    """
+    Translate a document and save both outputs from a single load.
 
     Parameters:
     - docx_filename: Input document filename
-    - output_filename: Output document filename
+    - output_filename: Output filename for the dual-language document
+    - translated_filename: Output filename for the translation-only document
+    - cache_filename: Translation cache database
     - args: Command line arguments
-    - translation_only: If True, only include translations in output
     """
     # Load the document
     doc = Document(docx_filename)
+    stories = load_stories(doc)
+    paragraphs, others = extract_paragraphs(doc, stories)
 
-    final_paragraphs, paragraph_maps = process_paragraphs(doc)
-
-    with SqlWrapper(f'output/{config["CN_TITLE"]}/buffer.db') as cache:
-        for i, p in enumerate(doc.paragraphs):
-            if i not in final_paragraphs:
-                continue
-            text_to_translate = p.text.strip()
-            while i in paragraph_maps and paragraph_maps[i]:
-                text_to_translate = (
-                    doc.paragraphs[paragraph_maps[i]].text.strip()
-                    + " "
-                    + text_to_translate
-                )
-                i = paragraph_maps[i]
-            if text_to_translate in cache and validate(
-                text_to_translate, cache[text_to_translate]
-            ):
-                translated_text = cache[text_to_translate]
-            elif text_to_translate.isdigit():
-                continue
-            else:
-                translated_text = translate(text_to_translate, dryrun=args.dryrun)
-                if not args.dryrun:
-                    cache[text_to_translate] = translated_text
+    groups = group_paragraphs(paragraphs)
 
-            if translation_only:
-                add_text_to_paragraph(p, translated_text, translation_only=True)
-            else:
-                add_text_to_paragraph(p, "\n" + translated_text)
+    with SqlWrapper(cache_filename) as cache:
+        translations = translate_groups(paragraphs, groups, cache, args)
+        targets = [(paragraphs[i], text) for i, text in translations.items()]
+        targets += translate_short_paragraphs(others, cache, args)
 
-    doc.save(output_filename)
+    # Styles are read before the first rendering modifies the runs
+    styles = [(get_style(p), is_bold(p)) for p, _ in targets]
 
+    for (p, translated_text), style in zip(targets, styles):
+        add_text_to_paragraph(p, "\n" + translated_text, style=style)
+    save_stories(doc, stories, output_filename)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--dryrun", action="store_true")
-    args = parser.parse_args()
+    # Replacing all runs also drops the ones added for the dual-language output
+    for (p, translated_text), style in zip(targets, styles):
+        add_text_to_paragraph(p, translated_text, translation_only=True, style=style)
+    save_stories(doc, stories, translated_filename)
 
-    if args.dryrun:
-        logger.warning("Dry run mode enabled. No translation will be performed.")
 
+def run(config, args):
+    get_executor(args.workers)
     output_dir = f'output/{config["CN_TITLE"]}'
-    logger.add(f"{output_dir}/info.log", colorize=True, level="DEBUG")
 
     # Generate both dual-language and translation-only outputs
-    translate_doc(
-        f"{output_dir}/input.docx", f'{output_dir}/{config["CN_TITLE"]}_dual.docx', args
-    )
     translate_doc(
         f"{output_dir}/input.docx",
+        f'{output_dir}/{config["CN_TITLE"]}_dual.docx',
         f'{output_dir}/{config["CN_TITLE"]}_translated.docx',
+        f"{output_dir}/buffer.db",
         args,
-        translation_only=True,
     )
+    save_report()
+    checkpoint("done")
+
+
+if __name__ == "__main__":
+    config = load_config()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dryrun", action="store_true")
+    parser.add_argument("--workers", type=int, help="Parallel API requests, by default WORKERS or the backend's max_concurrency")
+    parser.add_argument("--deadline", type=float,
+                        help="Minutes this run may take. Stops sending requests in time to write partial outputs")
+    args = parser.parse_args()
+
+    if args.dryrun:
+        logger.warning("Dry run mode enabled. No translation will be performed.")
+
+    logger.add(f'output/{config["CN_TITLE"]}/info.log', colorize=True, level="DEBUG")
+
+    set_deadline(args.deadline)
+    run(config, args)
+    exit_if_deadline_reached()
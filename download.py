@@ -3,25 +3,89 @@ import boto3
 import argparse
 from botocore.exceptions import ClientError
 import sys
+import glob
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dbsync import replay_changes
+from monitor import file_etag, MB
 
 
-def download_directory(s3_client, bucket_name, s3_folder, local_folder):
+CHUNK_SIZE = 8 * MB  # bytes per ranged request
+
+
+def matches_etag(path, etag):
+    """Whether the file has the content of an object with this ETag."""
+    if "-" not in etag:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "md5").hexdigest() == etag
+    # Multipart: only comparable when uploaded with our part size
+    return file_etag(path) == etag
+
+
+def download_file(s3_client, bucket_name, s3_path, local_path, size, etag):
+    """
+    Download an object in ranged chunks into a .part file named after its
+    ETag, so an interrupted download resumes where it stopped and a part of
+    an older version is never continued.
+    """
+    part_path = f"{local_path}.{etag[:16]}.part"
+    for stale in glob.glob(glob.escape(local_path) + ".*.part"):
+        if stale != part_path:
+            os.remove(stale)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset:
+        print(f"Resuming {s3_path} at {offset} of {size} bytes")
+    else:
+        print(f"Downloading {s3_path} to {local_path}")
+    with open(part_path, "ab") as f:
+        while offset < size:
+            end = min(offset + CHUNK_SIZE, size) - 1
+            response = s3_client.get_object(Bucket=bucket_name, Key=s3_path, Range=f"bytes={offset}-{end}")
+            for block in response["Body"].iter_chunks(MB):
+                f.write(block)
+            offset = f.tell()
+    if "-" not in etag and not matches_etag(part_path, etag):
+        os.remove(part_path)
+        raise ValueError("content does not match the ETag")
+    os.replace(part_path, local_path)
+
+
+def download_directory(s3_client, bucket_name, s3_folder, local_folder, workers=8):
+    """
+    Download the objects under s3_folder in parallel, skipping local files
+    that are already identical.
+    """
+    jobs = []
     paginator = s3_client.get_paginator('list_objects_v2')
     for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_folder):
         for obj in page.get('Contents', []):
-            if not obj['Key'].endswith('/'):  # skip directories
-                s3_file_path = obj['Key']
-                local_file_path = os.path.join(local_folder, os.path.relpath(s3_file_path, s3_folder))
-                local_file_dir = os.path.dirname(local_file_path)
-
-                # Ensure the directory exists
-                os.makedirs(local_file_dir, exist_ok=True)
+            if obj['Key'].endswith('/'):  # skip directories
+                continue
+            s3_file_path = obj['Key']
+            local_file_path = os.path.join(local_folder, os.path.relpath(s3_file_path, s3_folder))
+            etag = obj['ETag'].strip('"')
+            if (os.path.isfile(local_file_path) and os.path.getsize(local_file_path) == obj['Size']
+                    and matches_etag(local_file_path, etag)):
+                continue
+            # Ensure the directory exists
+            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+            jobs.append((s3_file_path, local_file_path, obj['Size'], etag))
 
-                try:
-                    print(f"Downloading {s3_file_path} to {local_file_path}")
-                    s3_client.download_file(bucket_name, s3_file_path, local_file_path)
-                except Exception as e:
-                    print(f"Failed to download {s3_file_path}: {e}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(download_file, s3_client, bucket_name, s3_file_path, local_file_path, size, etag):
+                s3_file_path
+            for s3_file_path, local_file_path, size, etag in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to download {futures[future]}: {e}")
+    if not jobs:
+        print("Everything is up to date.")
+    # Databases arrive as a snapshot plus changeset segments
+    replay_changes(local_folder)
 
 
 def main():
@@ -32,6 +96,7 @@ def main():
     parser.add_argument("secret_key", help="S3 Secret Access Key")
     parser.add_argument("endpoint_url", help="S3 Endpoint URL")
     parser.add_argument("bucket_name", help="S3 Bucket Name", default="book", nargs="?")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel downloads")
 
     args = parser.parse_args()
 
@@ -51,7 +116,7 @@ def main():
     # Verify bucket existence
     try:
         s3_client.head_bucket(Bucket=args.bucket_name)
-        download_directory(s3_client, args.bucket_name, args.s3_folder, args.local_folder)
+        download_directory(s3_client, args.bucket_name, args.s3_folder, args.local_folder, args.workers)
     except ClientError as e:
         error_code = e.response['Error']['Code']
         if error_code == '404':
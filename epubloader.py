@@ -9,9 +9,10 @@ import re
 import warnings
 import yaml
 import time
-from translate import translate, align_translate, validate, SqlWrapper
-from utils import load_config, update_content, get_filtered_tags, replace_section_titles, postprocess
-from utils import wrap_text, unwrap_text
+from translate import translate, translate_segment, align_translate, validate, SqlWrapper, current_chapter, save_report, checkpoint
+from translate import TranslationFailed, set_deadline, exit_if_deadline_reached, get_executor
+from utils import load_config, update_content, extract_segments, replace_section_titles, postprocess
+from utils import wrap_text, copy_soup, TitleReplacer, passthrough_segments
 
 
 warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
@@ -19,21 +20,49 @@ warnings.filterwarnings('ignore', category=UserWarning)
 with open("translation.yaml", "r") as f:
     translation_config = yaml.load(f, Loader=yaml.FullLoader)
 webapp = None
-MAX_LENGTH = 4000
 TRANSLATED_ATTR = "data-translated"
 
 
-def main():
-    config = load_config()
-    logger.add(f"output/{config['CN_TITLE']}/info.log", colorize=True, level="DEBUG")
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--dryrun", action="store_true")
-    parser.add_argument("--polish", action="store_true")
-    args = parser.parse_args()
-    
-    if args.dryrun:
-        logger.warning("Dry run mode enabled. No translation will be performed.")
+def is_chapter(item):
+    return isinstance(item, epub.EpubHtml) and not isinstance(item, epub.EpubNav) \
+        and "TOC" not in item.id and "toc" not in item.id
 
+
+def collect_titles(book):
+    """
+    Collect every title of the book in one pass: NCX navpoints, EPUB3 nav
+    entries and the <h1>-<h3> headings of each chapter in OPF spine order.
+    Returns the distinct titles in order of first appearance.
+    """
+    titles = {}
+    for item in book.get_items():
+        if isinstance(item, epub.EpubNcx):
+            soup = BeautifulSoup(item.content.decode("utf-8"), "html5lib")
+            for navpoint in soup.find_all("navpoint"):
+                text = navpoint.find('text')
+                if text:
+                    titles[text.get_text(strip=True)] = None
+        elif isinstance(item, epub.EpubNav):
+            soup = BeautifulSoup(item.content.decode("utf-8"), "html5lib")
+            for a_tag in soup.find_all("a"):
+                titles[a_tag.get_text(strip=True)] = None
+
+    spine = [book.get_item_with_id(idref) for idref, _ in book.spine]
+    chapters = [item for item in spine if item is not None and is_chapter(item)]
+    in_spine = {id(item) for item in chapters}
+    chapters += [item for item in book.get_items() if is_chapter(item) and id(item) not in in_spine]
+    for item in chapters:
+        soup = BeautifulSoup(wrap_text(item.content.decode("utf-8")), "html5lib")
+        for node, text in extract_segments(soup):
+            if node.name in ['h1', 'h2', 'h3']:
+                titles[text] = None
+
+    titles.pop("", None)
+    return list(titles)
+
+
+def run(config, args):
+    get_executor(args.workers)
     # Open the EPUB file
     book = epub.read_epub(f"output/{config['CN_TITLE']}/input.epub", {"ignore_ncx": False})
     if book.uid is None:
@@ -52,41 +81,36 @@ def main():
         if config['JP_TITLE'] not in title_buffer:
             title_buffer[config['JP_TITLE']] = config['CN_TITLE']
         
-        ############ Translate the chapter titles ############
-        ncx = None
-        for item in book.get_items():
-            if isinstance(item, epub.EpubNcx):
-                ncx = item
-                break
-        
-        if ncx:
-            content = ncx.content.decode("utf-8")
-            soup = BeautifulSoup(content, "html5lib")
-            navpoints = soup.find_all("navpoint")
-            jp_titles = []
-            for navpoint in navpoints:
-                name = navpoint.find('text').get_text(strip=True)
-                jp_titles.append(name)
-            
-            # Traverse the aggregated chapter titles
-            align_translate(jp_titles, title_buffer, args.dryrun)
-            replace_section_titles(cn_book.toc, title_buffer)
-            replace_section_titles(modified_book.toc, title_buffer, cnjp=True)
+        ############ Translate all titles of the book in one batch ############
+        jp_titles = collect_titles(book)
+        pending_titles = [
+            jp_title for jp_title in jp_titles
+            if jp_title != config['JP_TITLE']
+            and not (jp_title in title_buffer and validate(jp_title, title_buffer[jp_title]))
+        ]
+        if pending_titles and not args.dryrun:
+            current_chapter.set("titles")
+            align_translate(pending_titles, title_buffer, args.dryrun)
+        title_map = {jp_title: title_buffer[jp_title] for jp_title in jp_titles if jp_title in title_buffer}
+        if config['JP_TITLE'] in title_buffer:
+            title_map[config['JP_TITLE']] = title_buffer[config['JP_TITLE']]
+        title_replacer = TitleReplacer(title_map)
+        replace_section_titles(cn_book.toc, title_map)
+        replace_section_titles(modified_book.toc, title_map, cnjp=True)
         
         total_items = 0
         for item in tqdm(list(book.get_items())):
-            if isinstance(item, epub.EpubHtml) and not isinstance(item, epub.EpubNav) \
-            and "TOC" not in item.id and "toc" not in item.id:
+            if is_chapter(item):
                 total_items += 1
         current_items = 0
         current_time = None
     
         ############ Translate the chapters and TOCs ############
         for item in list(book.get_items()):
-            if isinstance(item, epub.EpubHtml) and not isinstance(item, epub.EpubNav) \
-            and "TOC" not in item.id and "toc" not in item.id:
+            if is_chapter(item):
                 
                 current_items += 1
+                current_chapter.set(item.get_name())
                 logger.info(f"Translating {item.id} ({current_items}/{total_items}) ...")
                 # Estimate remaining time
                 if current_items > 1:
@@ -96,38 +120,37 @@ def main():
                 current_time = time.time()
                 
                 # Parse HTML and extract text
-                content = wrap_text(item.content.decode("utf-8"))
+                readings = {}
+                content = wrap_text(item.content.decode("utf-8"), readings)
                 soup = BeautifulSoup(content, "html5lib")
-                cn_soup = BeautifulSoup(content, "html5lib")
+                cn_soup = copy_soup(soup)
                 
-                for rt_tag in soup.find_all("rt"):
-                    rt_tag.decompose()
-                for rt_tag in cn_soup.find_all("rt"):
-                    rt_tag.decompose()
-                
-                titles_and_paragraphs = get_filtered_tags(soup)
-                cn_titles_and_paragraphs = get_filtered_tags(cn_soup)
+                titles_and_paragraphs = extract_segments(soup)
+                cn_titles_and_paragraphs = [node for node, _ in extract_segments(cn_soup)]
+                passthrough = passthrough_segments([text for _, text in titles_and_paragraphs])
                 
                 last_text = None
-                for title, cnonly in zip(titles_and_paragraphs, cn_titles_and_paragraphs):
-                    if title.find_all(attrs={TRANSLATED_ATTR: True}):
-                        continue
+                for (title, text), cnonly, skip in zip(titles_and_paragraphs, cn_titles_and_paragraphs, passthrough):
                     if title.name in ['h1', 'h2', 'h3']:
-                        jp_title = title.get_text().strip()
+                        jp_title = text
                         if jp_title in title_buffer and validate(jp_title, title_buffer[jp_title]):
                             cn_title = title_buffer[jp_title]
+                        elif args.polish:
+                            cn_title = jp_title
+                        elif re.sub(r'\s', '', jp_title) == re.sub(r'\s', '', config['JP_TITLE']):
+                            cn_title = config['CN_TITLE']
+                        elif skip:
+                            cn_title = jp_title
+                        elif args.dryrun:
+                            cn_title = translate(jp_title, dryrun=args.dryrun)
                         else:
-                            ### Start translation
-                            if args.polish:
-                                cn_title = jp_title
-                            elif re.sub(r'\s', '', jp_title) == re.sub(r'\s', '', config['JP_TITLE']):
-                                cn_title = config['CN_TITLE']
-                            else:
-                                cn_title = translate(jp_title, dryrun=args.dryrun)
-                                if not args.dryrun:
-                                    title_buffer[jp_title] = cn_title
-                            ### Translation finished
+                            # Titles were batch translated up front, keep the original if that failed
+                            logger.warning(f"No translation for title {jp_title}, keeping the original")
+                            cn_title = jp_title
                         cn_title = postprocess(cn_title)
+                        if cn_title == jp_title:
+                            # Untranslated, both books keep the original heading once
+                            continue
                             
                         new_title = soup.new_tag(title.name, **{k: v for k, v in title.attrs.items()})
                         new_title[TRANSLATED_ATTR] = "zh"
@@ -136,8 +159,9 @@ def main():
                         cnonly.decompose()
                         title.insert_after(new_title)
                     else:
-                        jp_text = title.get_text().strip()
-                        if len(jp_text.strip()) == 0:
+                        jp_text = text
+                        if len(jp_text.strip()) == 0 or skip:
+                            # Nothing to translate, both books keep the original
                             continue
                         # Remove images
                         img_pattern = re.compile(r'<img[^>]+>')
@@ -149,23 +173,21 @@ def main():
                             if jp_text in buffer and validate(jp_text, buffer[jp_text]):
                                 cn_text = buffer[jp_text]
                             else:
-                                cn_text = translate(jp_text, dryrun=args.dryrun)
+                                try:
+                                    cn_text = translate_segment(jp_text, dryrun=args.dryrun, readings=readings)
+                                except TranslationFailed:
+                                    # Rejected or out of time, leave it for the next run
+                                    return None
                                 if not args.dryrun:
                                     buffer[jp_text] = cn_text
                             ### Translation finished
                             cn_text = postprocess(cn_text)
                             return cn_text
                         
-                        if len(jp_text) > MAX_LENGTH:
-                            # Split the title into smaller chunks by paragraphs
-                            jp_text_chunks = jp_text.split("\n\n")
-                            cn_text_chunks = []
-                            for i in range(len(jp_text_chunks)):
-                                if len(jp_text_chunks[i].strip()) > 0:
-                                    cn_text_chunks.append(translate_helper(jp_text_chunks[i]))
-                            cn_text = "\n\n".join(cn_text_chunks)
-                        else:
-                            cn_text = translate_helper(jp_text)
+                        cn_text = translate_helper(jp_text)
+                        if cn_text is None:
+                            # Both books keep the original paragraph
+                            continue
                         
                         new_text = soup.new_tag(title.name, **{k: v for k, v in title.attrs.items()})
                         new_text.string = cn_text
@@ -186,24 +208,19 @@ def main():
                             cnonly.insert_before(BeautifulSoup(img, "html5lib"))
                             title.insert_before(BeautifulSoup(img, "html5lib"))
                     
-                update_content(item, modified_book, title_buffer, soup)
-                update_content(item, cn_book, title_buffer, cn_soup)
+                update_content(item, modified_book, title_map, soup)
+                update_content(item, cn_book, title_map, cn_soup)
+                checkpoint("chapter", chapter=item.get_name())
                 
             ### Handle TOC and Ncx updates
             elif isinstance(item, epub.EpubNcx) or \
             (isinstance(item, epub.EpubHtml) and ("TOC" in item.id or "toc" in item.id)):
                     
-                # Update titles to CN titles or CN+JP titles in TOC
-                content = item.content.decode("utf-8")
-                cn_content = deepcopy(content)
-                for jp_title in jp_titles:
-                    if jp_title in title_buffer:
-                        cn_title = title_buffer[jp_title]
-                        content = content.replace(jp_title, cn_title)
-                        cn_content = cn_content.replace(jp_title, cn_title)
+                # Update titles to CN titles in TOC
+                content = title_replacer.replace(item.content.decode("utf-8"))
                 
-                update_content(item, modified_book, title_buffer, content)
-                update_content(item, cn_book, title_buffer, cn_content)
+                update_content(item, modified_book, title_map, content)
+                update_content(item, cn_book, title_map, content)
             
             else:
                 # Copy other items
@@ -224,6 +241,27 @@ def main():
     
     epub.write_epub(f"output/{config['CN_TITLE']}/{config['CN_TITLE']}_cnen.epub", modified_book)
     epub.write_epub(f"output/{config['CN_TITLE']}/{config['CN_TITLE']}_cn.epub", cn_book)
+    save_report()
+    checkpoint("done")
+
+
+def main():
+    config = load_config()
+    logger.add(f"output/{config['CN_TITLE']}/info.log", colorize=True, level="DEBUG")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dryrun", action="store_true")
+    parser.add_argument("--polish", action="store_true")
+    parser.add_argument("--workers", type=int, help="Parallel API requests, by default WORKERS or the backend's max_concurrency")
+    parser.add_argument("--deadline", type=float,
+                        help="Minutes this run may take. Stops sending requests in time to write partial outputs")
+    args = parser.parse_args()
+    
+    if args.dryrun:
+        logger.warning("Dry run mode enabled. No translation will be performed.")
+
+    set_deadline(args.deadline)
+    run(config, args)
+    exit_if_deadline_reached()
 
 
 if __name__ == "__main__":
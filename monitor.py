@@ -1,31 +1,184 @@
 import os
 import boto3
 import argparse
+import hashlib
+import json
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import NoCredentialsError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+import signal
 import sys
+import threading
 import time
+from checkpoints import CHECKPOINT_NAME, CheckpointReader
+from dbsync import SYNC_DIR, is_database, sync_database
 
 
-def upload_directory(s3_client, local_folder, bucket_name, s3_folder):
+MB = 1024 * 1024
+# Fixed part size, so the ETag of a multipart upload can be computed locally
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * MB, multipart_chunksize=8 * MB)
+MANIFEST_NAME = ".sync_manifest.json"
+POLL_INTERVAL = 2  # seconds between checks for new checkpoint events
+
+
+def file_etag(path, config=TRANSFER_CONFIG):
+    """
+    Return the ETag S3 gives the file when uploaded with config: the MD5 of
+    the content, or for multipart uploads the MD5 of the part digests
+    followed by the number of parts.
+    """
+    digests = []
+    with open(path, "rb") as f:
+        for part in iter(lambda: f.read(config.multipart_chunksize), b""):
+            digests.append(hashlib.md5(part))
+    if os.path.getsize(path) < config.multipart_threshold:
+        return digests[0].hexdigest() if digests else hashlib.md5(b"").hexdigest()
+    combined = hashlib.md5(b"".join(digest.digest() for digest in digests))
+    return f"{combined.hexdigest()}-{len(digests)}"
+
+
+def load_manifest(local_folder):
+    # {relative path: {"size", "mtime", "etag"}} of the files as last uploaded
+    try:
+        with open(os.path.join(local_folder, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(local_folder, manifest):
+    path = os.path.join(local_folder, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def seed_manifest(s3_client, local_folder, bucket_name, s3_folder, manifest):
+    """
+    Add local files that are already identical in the bucket, e.g. right
+    after download.py restored the folder, so they are not uploaded again.
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_folder):
+        for obj in page.get('Contents', []):
+            relative_path = os.path.relpath(obj['Key'], s3_folder)
+            local_path = os.path.join(local_folder, relative_path)
+            if relative_path in manifest or not os.path.isfile(local_path):
+                continue
+            stat = os.stat(local_path)
+            etag = obj['ETag'].strip('"')
+            if stat.st_size == obj['Size'] and file_etag(local_path) == etag:
+                manifest[relative_path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "etag": etag}
+
+
+def changed_files(local_folder, manifest):
+    """
+    Yield (local path, relative path, entry) for files that differ from the
+    manifest. Files whose size and mtime are unchanged are not read; files
+    touched without a content change only get their mtime updated.
+    """
     for root, dirs, files in os.walk(local_folder):
+        dirs[:] = [d for d in dirs if d != SYNC_DIR]
         for filename in files:
+            # Databases are shipped by sync_database, never as live files
+            if filename.startswith((MANIFEST_NAME, CHECKPOINT_NAME)) or is_database(filename) or ".db-" in filename:
+                continue
             local_path = os.path.join(root, filename)
             relative_path = os.path.relpath(local_path, local_folder)
-            s3_path = os.path.join(s3_folder, relative_path)
+            stat = os.stat(local_path)
+            entry = manifest.get(relative_path)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                continue
+            etag = file_etag(local_path)
+            if entry and entry["etag"] == etag:
+                entry.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+                continue
+            yield local_path, relative_path, {"size": stat.st_size, "mtime": stat.st_mtime_ns, "etag": etag}
+
+
+def upload_file(s3_client, local_path, bucket_name, s3_path):
+    try:
+        print(f"Uploading {local_path} to {s3_path}")
+        s3_client.upload_file(local_path, bucket_name, s3_path, Config=TRANSFER_CONFIG)
+        return True
+    except NoCredentialsError:
+        print("Credentials not available.")
+        sys.exit(1)
+    except ClientError as e:
+        print(f"Failed to upload {local_path} to {s3_path}: {e}")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return False
 
-            try:
-                print(f"Uploading {local_path} to {s3_path}")
-                s3_client.upload_file(local_path, bucket_name, s3_path)
-            except NoCredentialsError:
-                print("Credentials not available.")
-                sys.exit(1)
-            except ClientError as e:
-                print(f"Failed to upload {local_path} to {s3_path}: {e}")
-            except Exception as e:
-                print(f"Unexpected error: {e}")
+
+def upload_directory(s3_client, local_folder, bucket_name, s3_folder, manifest=None, workers=8):
+    """
+    Upload the files of local_folder that changed since the last upload,
+    small files in parallel and large ones as multipart uploads, then the
+    new rows of the databases.
+    """
+    if manifest is None:
+        manifest = load_manifest(local_folder)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (executor.submit(upload_file, s3_client, local_path, bucket_name, os.path.join(s3_folder, relative_path)),
+             relative_path, entry)
+            for local_path, relative_path, entry in changed_files(local_folder, manifest)
+        ]
+        for future, relative_path, entry in futures:
+            if future.result():
+                manifest[relative_path] = entry
+    save_manifest(local_folder, manifest)
+
+    def upload(local_path, s3_path):
+        return upload_file(s3_client, local_path, bucket_name, s3_path)
+
+    databases_uploaded = False
+    for root, dirs, files in os.walk(local_folder):
+        dirs[:] = [d for d in dirs if d != SYNC_DIR]
+        for filename in filter(is_database, files):
+            relative_path = os.path.relpath(os.path.join(root, filename), local_folder)
+            if sync_database(s3_client, local_folder, relative_path, bucket_name,
+                             os.path.join(s3_folder, relative_path), upload):
+                databases_uploaded = True
+    if not futures and not databases_uploaded:
+        print("No changes to upload.")
+    return manifest
+
+
+def watch(sync, local_folder, debounce, max_delay, stop):
+    """
+    Call sync() when the loaders report progress: once no checkpoint event
+    arrived for debounce seconds, once the oldest unsynced event is
+    max_delay seconds old, or right after a run is done. Sync a last time
+    once stop is set or on Ctrl+C.
+    """
+    reader = CheckpointReader(local_folder)
+    first_event = last_event = None
+    try:
+        while not stop.wait(POLL_INTERVAL):
+            events = reader.read()
+            now = time.time()
+            if events:
+                first_event = first_event or now
+                last_event = now
+            if first_event is None:
+                continue
+            if (any(event["event"] == "done" for event in events)
+                    or now - last_event >= debounce or now - first_event >= max_delay):
+                sync()
+                first_event = last_event = None
+    except KeyboardInterrupt:
+        pass
+    print("Stopping, syncing a last time...")
+    sync()
 
 
 def main():
+    # A SIGTERM during startup or the first sync must still end in a last sync
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
     parser = argparse.ArgumentParser(description="Upload a local directory to an S3 bucket.")
     parser.add_argument("local_folder", help="Local folder to upload")
     parser.add_argument("s3_folder", help="S3 folder to upload to")
@@ -34,9 +187,14 @@ def main():
     parser.add_argument("endpoint_url", help="S3 Endpoint URL")
     parser.add_argument("--bucket_name", help="S3 Bucket Name", default="book")
     parser.add_argument("--final", action="store_true", help="Run upload once and then quit")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel uploads")
+    parser.add_argument("--debounce", type=float, default=30,
+                        help="Seconds without new checkpoints before syncing")
+    parser.add_argument("--max_delay", type=float, default=300,
+                        help="Longest a checkpoint waits for a sync while new ones keep arriving")
 
     args = parser.parse_args()
-    
+
     # Use 'translator' as bucket name if endpoint contains backblazeb2.com and bucket_name is default
     if "backblazeb2.com" in args.endpoint_url and args.bucket_name == "book":
         args.bucket_name = "translator"
@@ -62,14 +220,18 @@ def main():
             print(f"An error occurred: {e}")
             sys.exit(1)
 
+    manifest = load_manifest(args.local_folder)
+    if not manifest:
+        seed_manifest(s3_client, args.local_folder, args.bucket_name, args.s3_folder, manifest)
+
+    def sync():
+        upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder, manifest, args.workers)
+
+    sync()
     if args.final:
-        upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder)
         print("Upload complete. Exiting.")
     else:
-        while True:
-            upload_directory(s3_client, args.local_folder, args.bucket_name, args.s3_folder)
-            print("Waiting 5 minutes before next sync...")
-            time.sleep(300)  # Sleep for 5 minutes
+        watch(sync, args.local_folder, args.debounce, args.max_delay, stop)
 
 
 if __name__ == "__main__":
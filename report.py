@@ -0,0 +1,89 @@
+from loguru import logger
+import json
+import threading
+import time
+
+
+class UsageStats:
+    def __init__(self):
+        self.requests = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.latency = 0.0
+        self.cost = 0.0
+        self.finish_reasons = {}
+
+    def add(self, result, cost):
+        self.requests += 1
+        self.input_tokens += result.input_tokens
+        self.cached_tokens += result.cached_tokens
+        self.output_tokens += result.output_tokens
+        self.latency += result.latency
+        self.cost += cost
+        reason = str(result.finish_reason)
+        self.finish_reasons[reason] = self.finish_reasons.get(reason, 0) + 1
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": round(self.cached_tokens / max(self.input_tokens, 1), 3),
+            "output_tokens": self.output_tokens,
+            "latency": round(self.latency, 2),
+            "avg_latency": round(self.latency / max(self.requests, 1), 2),
+            # Per request, concurrent requests are not added up
+            "output_tokens_per_second": round(self.output_tokens / max(self.latency, 1e-9), 1),
+            "cost": round(self.cost, 6),
+            "finish_reasons": self.finish_reasons,
+        }
+
+
+class RunReport:
+    """
+    Token usage, latency and cost of one book's requests, per model and per
+    chapter. Prices come from `input_price`, `cached_price` and
+    `output_price` (per million tokens) of the translation.yaml entry.
+    """
+
+    def __init__(self, translation_config):
+        self.translation_config = translation_config
+        self.models = {}
+        self.chapters = {}
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def cost(self, name, result):
+        model = self.translation_config.get(name, {})
+        cached_price = model.get('cached_price', model.get('input_price', 0))
+        return (
+            (result.input_tokens - result.cached_tokens) * model.get('input_price', 0)
+            + result.cached_tokens * cached_price
+            + result.output_tokens * model.get('output_price', 0)
+        ) / 1e6
+
+    def add(self, name, chapter, result):
+        cost = self.cost(name, result)
+        with self.lock:
+            self.models.setdefault(name, UsageStats()).add(result, cost)
+            self.chapters.setdefault(chapter or "", UsageStats()).add(result, cost)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "elapsed": round(time.time() - self.start, 1),
+                "models": {name: stats.to_dict() for name, stats in self.models.items()},
+                "chapters": {chapter: stats.to_dict() for chapter, stats in self.chapters.items()},
+            }
+
+    def save(self, path):
+        report = self.to_dict()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        for name, stats in report["models"].items():
+            logger.info(
+                f"{name}: {stats['requests']} requests, {stats['input_tokens']} input tokens "
+                f"({stats['cached_ratio']:.0%} cached), {stats['output_tokens']} output tokens, "
+                f"{stats['avg_latency']}s per request, ${stats['cost']:.4f}"
+            )
@@ -1,46 +1,153 @@
-from translate import align_translate, SqlWrapper
+from translate import align_translate, SqlWrapper, current_chapter, save_report, checkpoint
+from translate import set_deadline, exit_if_deadline_reached, get_executor
 from utils import load_config
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
-import re
 import argparse
+import contextvars
+import glob
+import os
+import re
+
+
+TIMING_RE = re.compile(r"^(\d+:)?\d{2}:\d{2}[,.]\d{3}\s*-->\s*(\d+:)?\d{2}:\d{2}[,.]\d{3}")
+WINDOW_SIZE = 20  # cues per request
+WINDOW_OVERLAP = 4  # preceding cues resent as context
+WINDOW_LENGTH = 500  # characters per request, below the block size of align_translate
+
+
+class Cue:
+    def __init__(self, index, timing, lines):
+        self.index = index  # cue number (SRT) or identifier (VTT), may be None
+        self.timing = timing  # timing line, kept verbatim including VTT settings
+        self.lines = lines
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
+
+    def serialize(self, lines=None):
+        head = [self.index] if self.index is not None else []
+        return "\n".join(head + [self.timing] + (self.lines if lines is None else lines))
+
+
+def parse_subtitles(content):
+    """
+    Parse SRT or WebVTT content into a list of blocks. Cues become Cue
+    objects; anything else (the WEBVTT header, NOTE and STYLE blocks) is kept
+    as a raw string.
+    """
+    content = content.lstrip("\ufeff").replace("\r\n", "\n").replace("\r", "\n")
+    blocks = []
+    for block in re.split(r"\n[ \t]*\n", content.strip()):
+        lines = block.split("\n")
+        timing = next((i for i, line in enumerate(lines[:2]) if TIMING_RE.match(line.strip())), None)
+        if timing is None:
+            blocks.append(block)
+        else:
+            index = lines[0].strip() if timing == 1 else None
+            blocks.append(Cue(index, lines[timing].strip(), [line.strip() for line in lines[timing + 1:]]))
+    return blocks
+
+
+def serialize_subtitles(blocks, translations, bilingual=False):
+    output = []
+    for block in blocks:
+        if isinstance(block, str):
+            output.append(block)
+        elif block.text in translations and translations[block.text].strip() != block.text.strip():
+            # A cue kept as it is shows once, not as its own translation
+            translated = translations[block.text].split("\n")
+            output.append(block.serialize(block.lines + translated if bilingual else translated))
+        else:
+            output.append(block.serialize())
+    return "\n\n".join(output) + "\n"
+
+
+def context_windows(cues):
+    """
+    Split cues into consecutive windows, each preceded by up to
+    WINDOW_OVERLAP cues of the previous window so every request carries
+    the neighbouring dialogue.
+    """
+    start = 0
+    while start < len(cues):
+        end, length = start, 0
+        while end < len(cues) and end - start < WINDOW_SIZE and (end == start or length < WINDOW_LENGTH):
+            length += len(cues[end].text)
+            end += 1
+        yield cues[max(0, start - WINDOW_OVERLAP):end]
+        start = end
 
 
-# Load the configuration
-config = load_config()
+def output_paths(config, path):
+    stem, ext = os.path.splitext(path)
+    if os.path.basename(stem) == "input":
+        stem = os.path.join(os.path.dirname(path), config['CN_TITLE'])
+    return f"{stem}_cn{ext}", f"{stem}_cnen{ext}"
+
+
+def translate_file(config, path, dryrun=False):
+    with open(path, "rb") as f:
+        blocks = parse_subtitles(f.read().decode("utf-8"))
+    cues = [block for block in blocks if isinstance(block, Cue) and block.text.strip()]
+    current_chapter.set(os.path.basename(path))
+
+    with SqlWrapper(f"output/{config['CN_TITLE']}/buffer.db") as buffer:
+        for window in context_windows(cues):
+            align_translate([cue.text for cue in window], buffer, dryrun)
+        translations = {cue.text: buffer[cue.text] for cue in cues if cue.text in buffer}
+
+    cn_path, cnen_path = output_paths(config, path)
+    with open(cn_path, "w", encoding="utf-8") as f:
+        f.write(serialize_subtitles(blocks, translations))
+    with open(cnen_path, "w", encoding="utf-8") as f:
+        f.write(serialize_subtitles(blocks, translations, bilingual=True))
+    logger.info(f"Translated {len(translations)}/{len(cues)} cues of {path}")
+    checkpoint("chapter", chapter=os.path.basename(path))
+
+
+def find_inputs(folder):
+    # input.srt, or every subtitle file of a season pack except our own outputs
+    paths = glob.glob(f"{folder}/*.srt") + glob.glob(f"{folder}/*.vtt")
+    return sorted(
+        path for path in paths
+        if not os.path.splitext(path)[0].endswith(("_cn", "_cnen"))
+    )
+
+
+FILES = 4  # subtitle files of a season pack translated at the same time
+
+
+def run(config, args):
+    get_executor(args.workers)
+    inputs = find_inputs(f"output/{config['CN_TITLE']}")
+    # Files only wait on requests, which run on the shared pool
+    with ThreadPoolExecutor(max_workers=getattr(args, "files", FILES)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, translate_file, config, path, args.dryrun)
+            for path in inputs
+        ]
+        for future in futures:
+            future.result()
+    save_report()
+    checkpoint("done")
 
 
 if __name__ == "__main__":
+    config = load_config()
+    logger.add(f"output/{config['CN_TITLE']}/info.log", colorize=True, level="DEBUG")
     parser = argparse.ArgumentParser()
     parser.add_argument("--dryrun", action="store_true")
+    parser.add_argument("--workers", type=int, help="Parallel API requests, by default WORKERS or the backend's max_concurrency")
+    parser.add_argument("--files", type=int, default=FILES, help="Subtitle files translated at the same time")
+    parser.add_argument("--deadline", type=float,
+                        help="Minutes this run may take. Stops sending requests in time to write partial outputs")
     args = parser.parse_args()
-    
+
     if args.dryrun:
         logger.warning("Dry run mode enabled. No translation will be performed.")
-    
-    # Open the document
-    with open(f"output/{config['CN_TITLE']}/input.srt", "rb") as f:
-        srt = f.read().decode("utf-8")
-    
-    # Parse srt by removing the time stamps
-    subtitles = re.sub(r"\[.* --> .*\]", "", srt)
-    subtitles = [subtitle.strip() for subtitle in subtitles.split("\n")]
-    
-    with SqlWrapper(f"output/{config['CN_TITLE']}/buffer.db") as buffer:
-        align_translate(subtitles, buffer, args.dryrun)
-
-        # Replace original subtitles with translated subtitles
-        cn_results = []
-        cnen_results = []
-        for line in srt.split("\n"):
-            subtitle = re.sub(r"\[.* --> .*\]", "", line).strip()
-            if subtitle == '' or subtitle not in buffer:
-                cn_results.append(line)
-                cnen_results.append(line)
-            else:
-                cn_results.append(line.replace(subtitle, buffer[subtitle]))
-                cnen_results.append(line.replace(subtitle, subtitle + " | " + buffer[subtitle]))
-        
-        with open(f"output/{config['CN_TITLE']}/{config['CN_TITLE']}_cn.srt", "w", encoding="utf-8") as f:
-            f.write("".join(cn_results))
-        with open(f"output/{config['CN_TITLE']}/{config['CN_TITLE']}_cnen.srt", "w", encoding="utf-8") as f:
-            f.write("".join(cnen_results))
+
+    set_deadline(args.deadline)
+    run(config, args)
+    exit_if_deadline_reached()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import sqlite3
+
+import dbsync
+
+
+class FakeBucket:
+    """Stands in for the S3 client and upload function, keeping objects as files."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def upload(self, local_path, s3_path):
+        path = os.path.join(self.folder, s3_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_path, path)
+        return True
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            path = os.path.join(self.folder, obj["Key"])
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def execute(db_path, *statements):
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT)')
+    for statement, params in statements:
+        conn.execute(statement, params)
+    conn.commit()
+    conn.close()
+
+
+def rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return dict(conn.execute('SELECT key, value FROM data'))
+    finally:
+        conn.close()
+
+
+def test_snapshot_and_changes_replay(tmp_path):
+    local, remote, restored = tmp_path / "local", tmp_path / "bucket", tmp_path / "restored"
+    os.makedirs(local / "book")
+    db_path = str(local / "book" / "buffer.db")
+    bucket = FakeBucket(str(remote))
+
+    def sync():
+        return dbsync.sync_database(bucket, str(local), os.path.join("book", "buffer.db"),
+                                    "book", "title/book/buffer.db", bucket.upload)
+
+    upsert = 'INSERT OR REPLACE INTO data VALUES (?, ?)'
+    execute(db_path, (upsert, ("一", "one")), (upsert, ("二", "two")))
+    assert sync()  # first sync uploads a snapshot
+    execute(db_path, (upsert, ("三", "three")), (upsert, ("一", "uno")))
+    assert sync()
+    execute(db_path, ('DELETE FROM data WHERE key=?', ("二",)))
+    assert sync()
+    assert not sync()  # nothing changed
+    assert sorted(os.listdir(remote / "title" / "book" / "buffer.db.changes")) == [
+        "00000001.json.gz", "00000002.json.gz",
+    ]
+
+    shutil.copytree(remote / "title", restored)
+    dbsync.replay_changes(str(restored))
+    assert rows(restored / "book" / "buffer.db") == {"一": "uno", "三": "three"}
+    assert not os.path.exists(restored / "book" / "buffer.db.changes")
+    assert dbsync.read_state(str(restored / "book" / "buffer.db"))[0] == 2
+
+
+def test_compaction_removes_replayed_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(dbsync, "COMPACT_SEGMENTS", 2)
+    local, remote = tmp_path / "local", tmp_path / "bucket"
+    os.makedirs(local)
+    db_path = str(local / "buffer.db")
+    bucket = FakeBucket(str(remote))
+    changes = remote / "buffer.db.changes"
+
+    for i in range(4):
+        execute(db_path, ('INSERT INTO data VALUES (?, ?)', (str(i), str(i))))
+        assert dbsync.sync_database(bucket, str(local), "buffer.db", "book", "buffer.db", bucket.upload)
+    # snapshot, two segments, then a new snapshot that contains them
+    assert not os.listdir(changes)
+    assert rows(remote / "buffer.db") == {"0": "0", "1": "1", "2": "2", "3": "3"}
+    assert dbsync.read_state(str(remote / "buffer.db"))[:2] == (2, 2)
@@ -0,0 +1,58 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def srtloader(tmp_path_factory):
+    # translate.py reads translation.yaml from the working directory on import
+    folder = tmp_path_factory.mktemp("srt")
+    (folder / "translation.yaml").write_text("{}\n")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(folder)
+        yield importlib.import_module("srtloader")
+
+
+SRT = (
+    "\ufeff1\r\n00:00:01,000 --> 00:00:02,500\r\nこんにちは\r\n元気？\r\n\r\n"
+    "2\r\n00:00:03,000 --> 00:00:04,000\r\n♪♪♪\r\n"
+)
+
+VTT = (
+    "WEBVTT\n\n"
+    "NOTE a comment\n\n"
+    "intro\n00:01.000 --> 00:02.000 align:start\nおはよう\n\n"
+    "00:03.000 --> 00:04.000\nさようなら\n"
+)
+
+
+def test_parse_srt(srtloader):
+    blocks = srtloader.parse_subtitles(SRT)
+    assert [(cue.index, cue.timing, cue.lines) for cue in blocks] == [
+        ("1", "00:00:01,000 --> 00:00:02,500", ["こんにちは", "元気？"]),
+        ("2", "00:00:03,000 --> 00:00:04,000", ["♪♪♪"]),
+    ]
+    expected = SRT.lstrip("\ufeff").replace("\r\n", "\n")
+    assert srtloader.serialize_subtitles(blocks, {}) == expected
+
+
+def test_parse_vtt(srtloader):
+    blocks = srtloader.parse_subtitles(VTT)
+    assert blocks[:2] == ["WEBVTT", "NOTE a comment"]
+    assert blocks[2].index == "intro"
+    assert blocks[2].timing == "00:01.000 --> 00:02.000 align:start"
+    assert blocks[3].index is None
+    assert srtloader.serialize_subtitles(blocks, {}) == VTT
+
+
+def test_serialize_translations(srtloader):
+    blocks = srtloader.parse_subtitles(SRT)
+    translations = {"こんにちは\n元気？": "你好\n还好吗？", "♪♪♪": "♪♪♪"}
+    assert srtloader.serialize_subtitles(blocks, translations) == (
+        "1\n00:00:01,000 --> 00:00:02,500\n你好\n还好吗？\n\n"
+        "2\n00:00:03,000 --> 00:00:04,000\n♪♪♪\n"
+    )
+    assert srtloader.serialize_subtitles(blocks, translations, bilingual=True) == (
+        "1\n00:00:01,000 --> 00:00:02,500\nこんにちは\n元気？\n你好\n还好吗？\n\n"
+        "2\n00:00:03,000 --> 00:00:04,000\n♪♪♪\n"
+    )
@@ -0,0 +1,36 @@
+from utils import passthrough_segments, split_by_tokens, halve, estimate_tokens
+
+
+def test_passthrough():
+    texts = ["https://example.com", "◇◇◇", "12", "今日はいい天気ですね。そうですね。", "Staff credits"]
+    assert passthrough_segments(texts) == [True, True, True, False, True]
+
+
+def test_kanji_only_lines_next_to_kana_are_translated():
+    assert passthrough_segments(["第一章　東京駅前決戦開始", "ここは東京です。"]) == [False, False]
+    assert passthrough_segments(["第一章　東京駅前決戦開始", "这里是东京。"]) == [True, True]
+
+
+PARAGRAPH = "　彼は静かに言った。「そうか、それならいい」と。" * 8 + "\n"
+
+
+def test_split_by_tokens_round_trip():
+    text = "\n\n".join([PARAGRAPH] * 6)
+    pieces = split_by_tokens(text, 200)
+    assert len(pieces) > 1
+    assert "".join(pieces) == text
+    assert all(estimate_tokens(piece) <= 200 for piece in pieces)
+
+
+def test_long_sentence_is_split_at_commas():
+    text = "あ、" * 400
+    pieces = split_by_tokens(text, 100)
+    assert "".join(pieces) == text
+    assert all(estimate_tokens(piece) <= 100 for piece in pieces)
+
+
+def test_halve():
+    first, second = halve(PARAGRAPH * 2)
+    assert first + second == PARAGRAPH * 2
+    assert first.rstrip().endswith("。")
+    assert halve("短い。") is None
@@ -0,0 +1,25 @@
+from validation import check_translation, Reason, Action, RETRY_POLICY, READING_HINT
+
+
+def test_repetition_before_truncation():
+    looping = "好的" * 40
+    assert check_translation("はい。" * 5, looping, "length") is Reason.REPETITION
+    assert RETRY_POLICY[Reason.REPETITION] is Action.LOWER_TEMPERATURE
+
+
+def test_truncated():
+    assert check_translation("これはペンです。", "这是", "max_tokens") is Reason.TRUNCATED
+    assert RETRY_POLICY[Reason.TRUNCATED] is Action.SPLIT
+
+
+def test_echo_and_refusal_come_first():
+    assert check_translation("本文", "无需翻译" * 20, "length") is Reason.REFUSED
+    assert check_translation("本文", READING_HINT + "文：ぶん\n正文", "stop") is Reason.PROMPT_ECHO
+    assert check_translation("http://example.com", "链接", "length") is Reason.SOURCE_IS_LINK
+
+
+def test_ratio():
+    assert check_translation("これはペンです。", "这是笔。") is Reason.OK
+    assert check_translation("これはペンです。" * 20, "笔") is Reason.TOO_SHORT
+    assert check_translation("ペン", "这是一支非常非常长的笔。") is Reason.TOO_LONG
+    assert check_translation("ペン", "") is Reason.OK
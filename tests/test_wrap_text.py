@@ -0,0 +1,29 @@
+from utils import wrap_text, unwrap_text
+
+
+def test_raw_text_is_kept():
+    html = (
+        "<html><head><style>div > p {}</style></head><body>"
+        "<style>p > a {}</style><script>if (a < b && c) {}</script>"
+        "<p>本文</p></body></html>"
+    )
+    wrapped = wrap_text(html)
+    assert "<style>div > p {}</style>" in wrapped
+    assert "<style>p > a {}</style>" in wrapped
+    assert "<script>if (a < b && c) {}</script>" in wrapped
+    assert '<p><span class="temp">本文</span></p>' in wrapped
+
+
+def test_round_trip():
+    html = (
+        "<html><head><title>題</title><style>div > p {}</style></head><body>"
+        "<p>一行目</p><pre>x &lt; y\n  z</pre><script>a && b</script></body></html>"
+    )
+    assert unwrap_text(wrap_text(html)) == html
+
+
+def test_spans_and_ruby():
+    readings = {}
+    wrapped = wrap_text("<p><span>梶</span><ruby>原<rt>わら</rt></ruby>です</p>", readings)
+    assert wrapped == '<p><span class="temp">梶原です</span></p>'
+    assert readings == {"原": "わら"}
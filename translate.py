@@ -1,205 +1,436 @@
-from apichat import LiteLLMChatApp, GoogleChatApp, PoeAPIChatApp, AnthropicChatApp, OpenAIChatApp, APITranslationFailure
+from apichat import create_chat_app, get_backend, backend_name, APITranslationFailure
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from loguru import logger
-import re
+import checkpoints
+import contextvars
+import difflib
+import os
+import functools
+import threading
 import yaml
 import sqlite3
+import sys
 import time
-from utils import split_string_by_length, get_leading_numbers, remove_leading_numbers, load_config, postprocess
+from utils import get_leading_numbers, remove_leading_numbers, load_config, postprocess
+from utils import ruby_hint, passthrough_segments, is_trivial, split_by_tokens, halve, keep_whitespace
+from report import RunReport
+from validation import check_translation, Reason, Action, RETRY_POLICY, DEFAULT_PROMPT, READING_HINT
 
 with open("translation.yaml", "r") as f:
     translation_config = yaml.load(f, Loader=yaml.FullLoader)
 
-config = load_config()
-logger.add(f"output/{config['CN_TITLE']}/info.log", colorize=True, level="DEBUG")
+# Loaders add the info.log sink of their book, batch mode one per book
+config = load_config(missing_ok=True)
 
+# Config of the book being translated. Defaults to .env, batch mode sets it per book.
+book_config = contextvars.ContextVar("book_config", default=config)
 
-def generate_prompt(jp_text):
+executor = None
+executor_workers = 0
+executor_lock = threading.Lock()
+
+
+def get_config():
+    return book_config.get()
+
+
+def get_executor(max_workers=None):
+    """
+    Return the worker pool shared by every loader and book in this process.
+    The first caller decides its size, by default WORKERS from .env, else the
+    concurrency the configured backends handle, else 4.
+    """
+    global executor, executor_workers
+    with executor_lock:
+        if executor is None:
+            if not max_workers:
+                max_workers = int(get_config().get('WORKERS', 0)) \
+                    or max(filter(None, concurrency.values()), default=4)
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            executor_workers = max_workers
+    return executor
+
+
+def get_workers(max_workers=None):
+    # Size of the shared pool, which may have been created by an earlier caller
+    get_executor(max_workers)
+    return executor_workers
+
+
+def submit(fn, *args, **kwargs):
+    # Run fn on the shared pool within the current book's config
+    return get_executor().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def map_parallel(fn, items):
+    """
+    Return [fn(item) for item in items], computed on the shared pool. The
+    caller runs the first item and takes back any item no worker has
+    started, so this is safe to call from inside a pool worker.
+    """
+    futures = [submit(fn, item) for item in items[1:]]
+    results = [fn(items[0])]
+    for item, future in zip(items[1:], futures):
+        results.append(fn(item) if future.cancel() else future.result())
+    return results
+
+
+class RateLimiter:
+    """Spaces out requests to stay under a requests-per-minute limit."""
+
+    def __init__(self, rpm):
+        self.interval = 60 / rpm if rpm else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+rate_limiters = {name: RateLimiter(model.get('rpm')) for name, model in translation_config.items()}
+# Requests in flight per model, from `max_concurrency` in translation.yaml or the backend's capabilities
+concurrency = {
+    name: model.get('max_concurrency', get_backend(backend_name(name, model)).capabilities.max_concurrency)
+    for name, model in translation_config.items()
+}
+concurrency_limits = {name: threading.BoundedSemaphore(n) if n else nullcontext() for name, n in concurrency.items()}
+
+
+MAX_SEGMENT_TOKENS = 1000  # longer text is split before it is sent
+MAX_SPLIT_DEPTH = 4
+
+# Used after a refusal or prompt echo
+STRICT_PROMPT = "将下面的外文文本直接翻译为中文，只输出译文，不要解释："
+
+# Chapter being translated, set by the loaders to break down the run report
+current_chapter = contextvars.ContextVar("current_chapter", default=None)
+reports = {}
+reports_lock = threading.Lock()
+
+
+def get_report():
+    # Usage report of the current book
+    title = get_config().get('CN_TITLE')
+    with reports_lock:
+        if title not in reports:
+            reports[title] = RunReport(translation_config)
+        return reports[title]
+
+
+def save_report():
+    get_report().save(f"output/{get_config()['CN_TITLE']}/report.json")
+
+
+DEADLINE_RESERVE = 120  # seconds left for in-flight requests and writing the outputs
+RESUMABLE_EXIT_CODE = 75  # stopped at the deadline, run again to continue
+
+
+class TranslationFailed(Exception):
+    """Raised when no acceptable translation was obtained. Nothing is cached, the next run retries."""
+
+
+class DeadlineReached(TranslationFailed):
+    """Raised instead of sending a request once the time budget is spent."""
+
+
+class Deadline:
+    """
+    Time budget of the process. Requests are timed, queueing included, and
+    a new one is only sent while it and the requests in flight are
+    predicted to finish before the reserve for writing the outputs.
+    """
+
+    def __init__(self, seconds, reserve=DEADLINE_RESERVE):
+        self.end = time.time() + seconds
+        self.reserve = reserve
+        self.request_time = 0.0
+        self.reached = False
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.request_time = 0.8 * self.request_time + 0.2 * seconds if self.request_time else seconds
+
+    def check(self):
+        with self.lock:
+            # Twice the average, for a request started now behind one just started
+            if not self.reached and time.time() + 2 * self.request_time + self.reserve >= self.end:
+                self.reached = True
+                logger.warning(
+                    f"{(self.end - time.time()) / 60:.1f} minutes left at "
+                    f"{self.request_time:.1f}s per request, no new requests are sent"
+                )
+            if self.reached:
+                raise DeadlineReached()
+
+
+deadline = None
+
+
+def set_deadline(minutes):
+    # Shared by every book in the process, the job limit applies to all of them
+    global deadline
+    deadline = Deadline(minutes * 60) if minutes else None
+
+
+def deadline_reached():
+    return deadline is not None and deadline.reached
+
+
+def exit_if_deadline_reached():
+    if deadline_reached():
+        logger.warning("Stopped at the deadline, untranslated text was kept in the original. Run again to continue")
+        sys.exit(RESUMABLE_EXIT_CODE)
+
+
+def checkpoint(event, **fields):
+    # Tell monitor.py there is progress worth uploading
+    checkpoints.emit(f"output/{get_config()['CN_TITLE']}", event, **fields)
+
+
+@functools.cache
+def load_glossary(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def generate_prompt(jp_text, readings=None):
+    """
+    Return the prompt as (prefix, message). The prefix (glossary and
+    instruction) is the same for every request of a book, so backends can
+    cache it; the message holds the text and its reading hints.
+    """
+    config = get_config()
     if 'PROMPT' not in config or config['PROMPT'] == '':
-        config['PROMPT'] = "将下面的外文文本翻译为中文："
-    return config['PROMPT'] + "\n" + jp_text
+        config['PROMPT'] = DEFAULT_PROMPT
+    prefix = config['PROMPT']
+    if config.get('GLOSSARY'):
+        prefix = "参考术语表：\n" + load_glossary(config['GLOSSARY']) + "\n\n" + prefix
+    hint = ruby_hint(jp_text, readings)
+    if hint:
+        return prefix, "（" + READING_HINT + hint + "）\n" + jp_text
+    return prefix, jp_text
+
+
+def record_usage(name, result):
+    get_report().add(name, current_chapter.get(), result)
+    logger.debug(
+        f"{name}: {result.input_tokens} input tokens ({result.cached_tokens} cached), "
+        f"{result.output_tokens} output tokens, {result.latency:.1f}s, finish reason {result.finish_reason}"
+    )
 
 
 def validate(jp_text, cn_text):
-    if "不需要翻译" in cn_text or "无需翻译" in cn_text:
-        return False
-    if jp_text.startswith("http"):
-        return False
-    # Check ratio of Chinese characters to English characters (avg 1.6)
-    if "将下面的外文文本翻译为中文：" in cn_text:
-        logger.warning(f"Validation failed: prompt detected in translation: {cn_text}")
-        return False
-    if len(cn_text) == 0:
-        return True
-    ratio = len(jp_text.strip()) / len(cn_text.strip())
-    if ratio < 0.5 or ratio > 10:
-        logger.warning(f"Validation failed: ratio of Chinese characters to English words: {ratio}")
-        return False
-    else:
-        return True
+    reason = check_translation(jp_text, cn_text, prompts=(DEFAULT_PROMPT, get_config().get('PROMPT')))
+    if reason is not Reason.OK:
+        logger.warning(f"Validation failed ({reason.value}): {cn_text}")
+    return reason is Reason.OK
     
     
+ALIGN_BLOCK_LENGTH = 600  # characters of numbered lines per request
+
+
 def align_translate(text_list, buffer, dryrun=False):
-    # Translate a aligned block of text
-    # Concatenate the text list
-    output = ''
-    special_line = {}
-    lines = set()
-    i = 0
-    for text in text_list:
-        text_updated = text.replace('\n', '')
-        if text_updated in lines:
-            continue  # Skip duplicate titles
-        else:
-            if text_updated != text:
-                special_line[text_updated] = text
-            lines.add(text_updated)
-            output += str(i) + " " + text_updated + "\n"
-            i += 1
-    blocks = split_string_by_length(output, 600)
-        
-    # Traverse the aggregated chapter titles
-    for text in blocks:
-        block_list = text.strip().split('\n')
-        
-        start_idx = get_leading_numbers(block_list[0])
-        end_idx = get_leading_numbers(block_list[-1])
-        
-        if not all([remove_leading_numbers(line) in buffer for line in block_list]):
-            cn_block_list = []
-            retry_count = int(config['TRANSLATION_TITLE_RETRY_COUNT']) + 1
-            
-            while len(cn_block_list) != len(block_list) and retry_count > 0:
-                ### Start translation
-                if dryrun:
-                    cn_text = text
-                elif text in buffer:
-                    cn_text = buffer[text]
-                else:
-                    cn_text = translate(text, mode="title_translation", dryrun=dryrun)
-                ### Translation finished
-                cn_text = postprocess(cn_text)
-                
-                ### Match translated line to the corresponding indices
-                cn_block_list = cn_text.strip().split('\n')
-                cn_block_list = [line for line in cn_block_list if line.strip()]  # Remove empty lines
-                
-                if len(cn_block_list) == len(block_list):
-                    # If the number of lines matches, assign leading numbers from original block_list
-                    cn_block_list = [
-                        f"{get_leading_numbers(block_list[i])} {cn_block_list[i].lstrip('0123456789. ')}"
-                        for i in range(len(block_list))
-                    ]
-                    break
-                
-                cn_block_list = [line for line in cn_block_list if get_leading_numbers(line) is not None]
-                if len(cn_block_list) == 0:
-                    continue
-                if get_leading_numbers(cn_block_list[0]) == start_idx and \
-                get_leading_numbers(cn_block_list[-1]) == end_idx:
-                    if len(cn_block_list) != len(block_list):
-                        # Insert missing lines
-                        cn_map = {}
-                        map = {}
-                        for line in block_list:
-                            i = get_leading_numbers(line)
-                            map[i] = line
-                        for line in cn_block_list:
-                            i = get_leading_numbers(line)
-                            cn_map[i] = line
-                        for i in range(start_idx, end_idx + 1):
-                            if i not in cn_map:
-                                if i + 1 in cn_map:
-                                    cn_map[i] = cn_map[i + 1]
-                                elif i - 1 in cn_map:
-                                    cn_map[i] = cn_map[i - 1]
-                                else:
-                                    cn_map[i] = map[i]
-                        block_list = [map[i] for i in range(start_idx, end_idx + 1)]
-                        cn_block_list = [cn_map[i] for i in range(start_idx, end_idx + 1)]
-                    break
-                else:
-                    retry_count -= 1
-
-            flag = True
-            if len(cn_block_list) != len(block_list):
-                logger.critical(f"Failed to translate {text} after {config['TRANSLATION_TITLE_RETRY_COUNT']} retries.")
-                logger.info(f"Falling back to no translation")
-                cn_block_list = block_list
-                flag = False
-            else:
-                buffer[text] = cn_text
-                
-            for cn_line, line in zip(cn_block_list, block_list):
-                line = remove_leading_numbers(line)
-                if line in special_line:
-                    line = special_line[line]
-                if flag:
-                    buffer[line] = remove_leading_numbers(cn_line)
-
-
-def translate(jp_text, mode="translation", dryrun=False):
-    # If number of non-digit letters is less than 2, return directly
-    if len(re.findall(r'[^\d]', jp_text)) < 2:
-        return jp_text
-    
-    # If it's a web link, return directly
-    if jp_text.startswith("https") or jp_text.startswith("http"):
-        # all valid characters in a URL
-        return jp_text
+    """
+    Translate short texts such as titles, subtitles or table cells as
+    numbered lines, several per request, and store each translation in
+    buffer under its text. Blocks with any uncached line are translated
+    whole, so cached lines still give context, and blocks run in parallel.
+    Cache access stays on the calling thread.
+    """
+    # Segments that need no translation are not sent and not cached, callers
+    # keep the original of texts missing from buffer
+    passthrough = passthrough_segments(text_list)
+
+    # Numbered lines, newlines removed, each with the texts it stands for
+    originals = {}
+    for text, skip in zip(text_list, passthrough):
+        if not skip:
+            originals.setdefault(text.replace('\n', ''), []).append(text)
+    entries = list(enumerate(originals))
+
+    blocks, block, length = [], [], 0
+    for i, line in entries:
+        size = len(str(i)) + len(line) + 2
+        if block and length + size > ALIGN_BLOCK_LENGTH:
+            blocks.append(block)
+            block, length = [], 0
+        block.append((i, line))
+        length += size
+    if block:
+        blocks.append(block)
+
+    # Translations are stored under the original texts, newlines included
+    cached = buffer.get_many(text for texts in originals.values() for text in texts)
+    blocks = [
+        block for block in blocks
+        if not all(text in cached for _, line in block for text in originals[line])
+    ]
+    if not blocks:
+        return
+
+    if dryrun:
+        # Nothing is sent, and identity translations must not end up in the cache
+        return
+
+    translations = {}
+    for result in map_parallel(translate_block, blocks):
+        translations.update(result)
+    buffer.update({
+        text: translations[i]
+        for i, line in entries if i in translations
+        for text in originals[line]
+    })
+
+
+def translate_block(block):
+    """
+    Translate a block of (index, line) and return {index: translation}.
+    Lines the response does not account for are sent again on their own,
+    up to TRANSLATION_TITLE_RETRY_COUNT times.
+    """
+    results = {}
+    pending = block
+    retry_count = int(get_config()['TRANSLATION_TITLE_RETRY_COUNT']) + 1
+    while pending and retry_count > 0:
+        retry_count -= 1
+        text = "\n".join(f"{i} {line}" for i, line in pending)
+        try:
+            cn_text, reason = try_translate(text)
+        except DeadlineReached:
+            logger.warning(f"Out of time, keeping the original of {len(pending)} lines")
+            return results
+        if reason is not Reason.API_ERROR:
+            results.update(align_lines(pending, postprocess(cn_text)))
+        pending = [(i, line) for i, line in pending if i not in results]
+    if pending:
+        logger.critical(
+            f"No translation for {len(pending)} lines after "
+            f"{get_config()['TRANSLATION_TITLE_RETRY_COUNT']} retries, keeping the original"
+        )
+    return results
+
+
+def align_lines(block, cn_text):
+    """
+    Match the lines of a numbered response to the (index, line) block sent.
+    Numbers anchor the alignment: the sequence of leading numbers in the
+    response is matched against the indices sent, and runs of garbled or
+    unnumbered lines fill gaps of the same size. Returns {index: translation}
+    for the lines that could be matched.
+    """
+    indices = [i for i, _ in block]
+    lines = [line.strip() for line in cn_text.strip().split('\n') if line.strip()]
+    numbers = [get_leading_numbers(line) for line in lines]
+
+    def strip_number(index, line):
+        return remove_leading_numbers(line) if get_leading_numbers(line) == index else line
+
+    if len(lines) == len(indices):
+        # Same line count, trust the order even if numbers were dropped
+        return {i: strip_number(i, line) for i, line in zip(indices, lines)}
+
+    results = {}
+    matcher = difflib.SequenceMatcher(None, indices, numbers, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal" or (tag == "replace" and i2 - i1 == j2 - j1):
+            for i, line in zip(indices[i1:i2], lines[j1:j2]):
+                results[i] = strip_number(i, line)
+    return {i: line for i, line in results.items() if line}
+
+
+def try_translate(jp_text, dryrun=False, readings=None, splittable=False):
+    """
+    Translate jp_text with the configured models in order. Returns the
+    translation and the Reason of the last rejection, Reason.OK on success.
+    A truncated answer is returned at once only if the caller can split
+    jp_text, otherwise it is retried like any other rejection.
+    Raises DeadlineReached instead of sending a request past the deadline.
+    """
+    # Numbers and links, return directly. Callers decide what else needs no
+    # translation, since that depends on the language of the whole chapter.
+    if is_trivial(jp_text):
+        return jp_text, Reason.OK
 
     flag = True
     cn_text = '翻译失败'
+    reason = Reason.API_ERROR
     
     if dryrun:
-        return "待翻译……"
+        return "待翻译……", Reason.OK
 
     logger.info("\n------ JP Message ------\n\n" + jp_text + "\n------------------------\n\n")
     
     for name, model in translation_config.items():
-        prompt = generate_prompt(jp_text)
-        logger.info("\n-------- Prompt --------\n\n" + prompt + "\n------------------------\n\n")
+        prefix, message = generate_prompt(jp_text, readings)
+        logger.info("\n-------- Prompt --------\n\n" + prefix + "\n" + message + "\n------------------------\n\n")
         
         retry_count = model['retry_count']
         logger.info("Translating using " + name + " ...")
         
         ### API translation
         if model['type'] == 'api':
-            if 'gemini' in name.lower():
-                api_app = GoogleChatApp(api_key=model['key'], model_name=model['name'])
-            elif 'poe' in name.lower():
-                api_app = PoeAPIChatApp(api_key=model['key'], model_name=model['name'])
-            elif 'claude' in name.lower():
-                api_app = AnthropicChatApp(api_key=model['key'], model_name=model['name'])
-            elif 'openai' in name.lower():
-                api_app = OpenAIChatApp(api_key=model['key'], model_name=model['name'], endpoint=model['endpoint'])
-            else:
-                api_app = LiteLLMChatApp(api_key=model['key'], model_name=model['name'])
-            
             backoff_time = 2  # Start with 2 seconds
             max_backoff_time = 64  # Maximum backoff time
+            temperature = None
+            prompts = (DEFAULT_PROMPT, prefix, STRICT_PROMPT)
             
             while flag and retry_count > 0:
+                retry_count -= 1
+                if deadline:
+                    deadline.check()
+                # A fresh app per attempt, so a rejected answer is not part of the next request
+                api_app = create_chat_app(name, model)
+                if temperature is not None:
+                    api_app.temperature = temperature
                 try:
-                    cn_text = api_app.chat(prompt)
-                    if "已经是中文" in cn_text:
-                        return jp_text
+                    start = time.time()
+                    rate_limiters[name].acquire()
+                    with concurrency_limits[name]:
+                        result = api_app.chat(message, prefix=prefix)
+                    if deadline:
+                        deadline.record(time.time() - start)
+                    record_usage(name, result)
+                    cn_text = result.text
                     if type(cn_text) is not str:
                         raise APITranslationFailure(f"Result is not string: {cn_text}")
-                    if not validate(jp_text, cn_text):
-                        raise APITranslationFailure(f"Validation failed: {cn_text}")
-                    flag = False
+                    if "已经是中文" in cn_text:
+                        return jp_text, Reason.OK
+                    reason = check_translation(jp_text, cn_text, result.finish_reason, prompts)
+                    if reason is Reason.OK:
+                        flag = False
+                        break
+                    logger.warning(f"Validation failed ({reason.value}): {cn_text}")
                 except APITranslationFailure as e:
                     if 'quota' in str(e):
                         retry_count += 1
                     logger.critical(f"API translation failed: {e}")
-                    if 'BILLING' in config and config['BILLING'] == 'True':
-                        pass
-                    else:
+                    reason = Reason.API_ERROR
+
+                action = RETRY_POLICY[reason]
+                logger.debug(f"{reason.value}: {action.value}")
+                if action is Action.SPLIT and splittable:
+                    # Other models would hit the same limit, leave it to translate_segment
+                    return cn_text, reason
+                elif action is Action.NEXT_MODEL:
+                    break
+                elif action is Action.BACKOFF:
+                    if get_config().get('BILLING') != 'True':
                         time.sleep(backoff_time)
-                    logger.debug(f"Retrying in {backoff_time} seconds ...")
                     backoff_time = min(backoff_time * 2, max_backoff_time)  # Exponential backoff
-                    pass
-                retry_count -= 1
+                elif action is Action.LOWER_TEMPERATURE:
+                    temperature = (getattr(api_app, "temperature", 1.0) if temperature is None else temperature) / 2
+                elif action is Action.STRICT_PROMPT:
+                    # Drop the glossary and reading hints, and insist on a bare translation
+                    prefix, message = STRICT_PROMPT, jp_text
         
         if not flag:
             break
@@ -211,20 +442,55 @@ def translate(jp_text, mode="translation", dryrun=False):
         if not flag:
             break
         
-    if mode == "remove_annotation":
-        return translate(cn_text, mode="polish", dryrun=dryrun)
-
     if type(cn_text) is not str:
         cn_text = "翻译失败"
     else:
         logger.info("\n------ CN Message ------\n\n" + cn_text + "\n------------------------\n\n")
                         
+    return cn_text, Reason.OK if not flag else reason
+
+
+def translate(jp_text, mode="translation", dryrun=False, readings=None):
+    cn_text, _ = try_translate(jp_text, dryrun, readings)
+    if mode == "remove_annotation":
+        return translate(cn_text, mode="polish", dryrun=dryrun)
     return cn_text
 
 
+def translate_segment(jp_text, dryrun=False, readings=None, depth=0):
+    """
+    Translate text of any length. It is split at sentence boundaries into
+    pieces of at most MAX_SEGMENT_TOKENS, and a piece whose translation is
+    truncated or rejected is halved and retried, up to MAX_SPLIT_DEPTH
+    times. Pieces are translated in parallel and joined with their
+    original whitespace. Raises TranslationFailed if a piece got no
+    acceptable translation, DeadlineReached if it ran out of time.
+    """
+    pieces = split_by_tokens(jp_text, MAX_SEGMENT_TOKENS)
+    if len(pieces) == 1:
+        halves = halve(jp_text) if depth < MAX_SPLIT_DEPTH else None
+        cn_text, reason = try_translate(jp_text, dryrun, readings, splittable=halves is not None)
+        if reason is Reason.OK:
+            return cn_text
+        # Smaller requests help with bad output, not with a failing API
+        if halves is None or reason in (Reason.API_ERROR, Reason.SOURCE_IS_LINK):
+            logger.error(f"No translation for a segment of {len(jp_text)} characters ({reason.value})")
+            raise TranslationFailed(reason.value)
+        logger.info(f"Splitting a segment of {len(jp_text)} characters after {reason.value}")
+        pieces = list(halves)
+    translations = map_parallel(lambda piece: translate_segment(piece, dryrun, readings, depth + 1), pieces)
+    return "".join(keep_whitespace(piece, cn_text) for piece, cn_text in zip(pieces, translations))
+
+
+CHECKPOINT_ROWS = 20  # new cache rows per checkpoint event
+
+
 class SqlWrapper:
+    conn = None
+
     def __init__(self, db_path):
         self.db_path = db_path
+        self.new_rows = 0
         self.conn = sqlite3.connect(self.db_path)
         self.cursor = self.conn.cursor()
         self.cursor.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT)')
@@ -244,6 +510,32 @@ class SqlWrapper:
     def __setitem__(self, key, value):
         self.cursor.execute('INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)', (key, value))
         self.conn.commit()
+        self.added(1)
+
+    def get_many(self, keys, batch_size=500):
+        # {key: value} for the keys present, in one query per batch
+        keys = list(keys)
+        result = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            self.cursor.execute(
+                f'SELECT key, value FROM data WHERE key IN ({",".join("?" * len(batch))})', batch
+            )
+            result.update(self.cursor.fetchall())
+        return result
+
+    def update(self, mapping):
+        # Insert or replace many entries in one transaction
+        self.cursor.executemany('INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)', mapping.items())
+        self.conn.commit()
+        self.added(len(mapping))
+
+    def added(self, rows, flush=False):
+        self.new_rows += rows
+        if self.new_rows >= CHECKPOINT_ROWS or (flush and self.new_rows):
+            checkpoints.emit(os.path.dirname(self.db_path) or ".", "rows",
+                             db=os.path.basename(self.db_path), rows=self.new_rows)
+            self.new_rows = 0
 
     def __delitem__(self, key):
         if key in self:
@@ -257,12 +549,16 @@ class SqlWrapper:
         return self.cursor.fetchone() is not None
 
     def close(self):
-        self.conn.close()
+        # Called again by __del__ after __exit__
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.added(0, flush=True)
         self.close()
 
     def __del__(self):
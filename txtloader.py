@@ -1,9 +1,59 @@
 import argparse
-import re
+from collections import deque
 from tqdm import tqdm
 from loguru import logger
-from translate import translate, validate, SqlWrapper
-from utils import load_config
+from translate import translate_segment, validate, SqlWrapper, get_workers, submit, save_report, checkpoint
+from translate import TranslationFailed, set_deadline, exit_if_deadline_reached
+from utils import load_config, iter_text_chunks, keep_whitespace
+
+
+def write_chunk(output, chunk, translated):
+    output.write(keep_whitespace(chunk, translated))
+    output.flush()
+
+
+def run(config, args):
+    workers = get_workers(args.workers)
+    with open(f"output/{config['CN_TITLE']}/input.txt", "r", encoding="utf-8") as file, \
+         open(f"output/{config['CN_TITLE']}/output.txt", "w", encoding="utf-8") as output, \
+         SqlWrapper(f"output/{config['CN_TITLE']}/buffer.db") as buffer:
+        # Chunks in input order, each with its cached translation or a pending future.
+        # Finished chunks are written as soon as every earlier chunk is written.
+        window = deque()
+        progress = tqdm(unit="chunk")
+
+        def write_finished(limit):
+            # Write finished chunks from the front of the window, waiting on the
+            # oldest one while more than `limit` chunks are queued
+            while window:
+                chunk, group, result = window[0]
+                if not isinstance(result, str):
+                    if len(window) <= limit and not result.done():
+                        break
+                    try:
+                        result = result.result()
+                        if not args.dryrun:
+                            buffer[group] = result
+                    except TranslationFailed:
+                        # Rejected or out of time, keep the original for the next run
+                        result = group
+                window.popleft()
+                write_chunk(output, chunk, result)
+                progress.update()
+
+        for chunk in iter_text_chunks(file):
+            group = chunk.strip()
+            if not group:
+                window.append((chunk, group, ""))
+            elif group in buffer and validate(group, buffer[group]):
+                window.append((chunk, group, buffer[group]))
+            else:
+                window.append((chunk, group, submit(translate_segment, group, dryrun=args.dryrun)))
+            write_finished(limit=2 * workers)
+        write_finished(limit=0)
+        progress.close()
+    save_report()
+    checkpoint("done")
 
 
 def main():
@@ -11,33 +61,17 @@ def main():
     logger.add(f"output/{config['CN_TITLE']}/info.log", colorize=True, level="DEBUG")
     parser = argparse.ArgumentParser()
     parser.add_argument("--dryrun", action="store_true")
+    parser.add_argument("--workers", type=int, help="Parallel API requests, by default WORKERS or the backend's max_concurrency")
+    parser.add_argument("--deadline", type=float,
+                        help="Minutes this run may take. Stops sending requests in time to write partial outputs")
     args = parser.parse_args()
     
     if args.dryrun:
         logger.warning("Dry run mode enabled. No translation will be performed.")
 
-    with open(f"output/{config['CN_TITLE']}/input.txt", "r", encoding="utf-8") as file:
-        content = file.read()
-
-    paragraphs = re.split(r"[。.]", content)
-    translated_paragraphs = []
-
-    with SqlWrapper(f"output/{config['CN_TITLE']}/buffer.db") as buffer:
-        group = ""
-        for paragraph in tqdm(paragraphs):
-            group += paragraph + "。"
-            if len(group) > 1000 or paragraph == paragraphs[-1]:
-                if group in buffer and validate(group, buffer[group]):
-                    translated_group = buffer[group]
-                else:
-                    translated_group = translate(group, dryrun=args.dryrun)
-                    if not args.dryrun:
-                        buffer[group] = translated_group
-                translated_paragraphs.append(translated_group)
-                group = ""
-
-    with open(f"output/{config['CN_TITLE']}/output.txt", "w", encoding="utf-8") as file:
-        file.write("\n".join(translated_paragraphs))
+    set_deadline(args.deadline)
+    run(config, args)
+    exit_if_deadline_reached()
 
 
 if __name__ == "__main__":
@@ -6,7 +6,9 @@ from loguru import logger
 from copy import deepcopy
 from ebooklib import epub
 import json
-from bs4 import BeautifulSoup, NavigableString, Comment, Tag
+from html import escape
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup, NavigableString, Tag, CData
 
 
 BLOCK_NAMES = {"h1", "h2", "h3", "h4", "h5", "h6", "p", "blockquote"}
@@ -43,10 +45,12 @@ def concat_kanji_rubi(text):
     return re.sub(pattern, replacement, text)
 
 
-def load_config(filepath=".env"):
+def load_config(filepath=".env", missing_ok=False):
     script_dir = os.path.dirname(os.path.abspath(__file__))
     filepath = os.path.join(script_dir, filepath)
     config = {}
+    if missing_ok and not os.path.exists(filepath):
+        return config
     with open(filepath, "r", encoding="utf-8") as file:
         for line in file:
             if line.startswith("#"):
@@ -88,7 +92,48 @@ def txt_to_html(text, tag="p"):
     return "\n".join(html_paragraphs)
 
 
-def get_filtered_tags(soup: BeautifulSoup):
+def extract_segments(soup: BeautifulSoup):
+    """
+    Return (node, text) pairs for every block of the chapter that should be
+    translated, where text is `node.get_text().strip()`.
+
+    Text and translated flags are computed bottom-up in one traversal, so each
+    string is visited once no matter how deeply the blocks are nested. Blocks
+    that already contain translated output are left out.
+    """
+    raw, stripped = [], []   # text nodes in document order
+    ranges = {}              # id(tag) -> (start, end) into raw / stripped
+    translated = set()       # ids of tags with a translated descendant
+
+    # post-order traversal with an explicit stack: a tag's range is closed
+    # once all of its children have been popped
+    stack = [(soup, False)]
+    while stack:
+        node, closing = stack.pop()
+
+        if not isinstance(node, Tag):
+            # only the string types get_text() would return
+            if type(node) in (NavigableString, CData):
+                raw.append(node)
+                stripped.append(node.strip())
+            continue
+
+        if closing:
+            ranges[id(node)] = (ranges[id(node)], len(raw))
+            if node.parent is not None and (
+                id(node) in translated or node.has_attr(TRANSLATED_ATTR)
+            ):
+                translated.add(id(node.parent))
+            continue
+
+        ranges[id(node)] = len(raw)
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(node.contents))
+
+    def text_of(node):
+        start, end = ranges[id(node)]
+        return "".join(raw[start:end]).strip(), "".join(stripped[start:end])
+
     targets, queued_texts = [], set()
 
     # depth‑first traversal with an explicit stack so we can
@@ -98,16 +143,11 @@ def get_filtered_tags(soup: BeautifulSoup):
     while stack:
         node, blocked = stack.pop()
 
-        if isinstance(node, NavigableString):
-            continue
-
-        # (a) if blocked above, propagate
-        if blocked:
-            stack.extend((child, True) for child in reversed(node.contents))
+        if not isinstance(node, Tag):
             continue
 
-        # (b) if this node or an ancestor is already translated
-        if node.has_attr(TRANSLATED_ATTR):
+        # if blocked above, or this node is already translated, propagate
+        if blocked or node.has_attr(TRANSLATED_ATTR):
             stack.extend((child, True) for child in reversed(node.contents))
             continue
 
@@ -132,10 +172,10 @@ def get_filtered_tags(soup: BeautifulSoup):
                 keep = True
 
         if keep:
-            text = node.get_text(strip=True)
-            if text and text not in queued_texts:
-                targets.append(node)
-                queued_texts.add(text)
+            text, key = text_of(node)
+            if key and key not in queued_texts:
+                targets.append((node, text))
+                queued_texts.add(key)
                 # children don’t need a blocked flag because we won’t iterate
                 # into them at all:
                 continue
@@ -143,22 +183,31 @@ def get_filtered_tags(soup: BeautifulSoup):
         # not queued – recurse into children
         stack.extend((child, False) for child in reversed(node.contents))
 
-    # Step 1 (wrapping raw text in clean divs) can be done lazily:
-    for div in (t for t in targets if t.name == "div"):
-        new_contents = []
-        for child in div.contents:
-            if isinstance(child, NavigableString):
-                txt = child.strip()
-                if txt:
-                    span = soup.new_tag("span")
-                    span.string = txt
-                    span[TRANSLATED_ATTR] = "src"
-                    new_contents.append(span)
-                    continue
-            new_contents.append(child)
-        div.contents[:] = new_contents
+    segments = []
+    for node, text in targets:
+        if id(node) in translated:
+            continue
+        if node.name == "div":
+            # raw text directly inside a clean div is moved into source spans,
+            # which marks the div as handled
+            new_contents, wrapped = [], False
+            for child in node.contents:
+                if isinstance(child, NavigableString):
+                    txt = child.strip()
+                    if txt:
+                        span = soup.new_tag("span")
+                        span.string = txt
+                        span[TRANSLATED_ATTR] = "src"
+                        new_contents.append(span)
+                        wrapped = True
+                        continue
+                new_contents.append(child)
+            if wrapped:
+                node.contents[:] = new_contents
+                continue
+        segments.append((node, text))
 
-    return targets
+    return segments
 
 
 def split_string_by_paragraphs(text):
@@ -182,6 +231,122 @@ def split_string_by_length(text, max_length=1000):
     return parts
 
 
+SENTENCE_END_RE = re.compile(r"(?:[。．！？]+|[.!?]+(?=\s))[」』）)”’]*\n*|\n+")
+
+
+def estimate_tokens(text):
+    """Rough token count: one per CJK character, one per four other characters."""
+    cjk = sum(1 for char in text if char >= "\u3000")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def iter_sentences(file, block_size=65536):
+    """
+    Lazily yield the sentences of a text file. Each sentence keeps its
+    delimiter, closing quotes and trailing newlines, so joining the output
+    reproduces the file exactly.
+    """
+    tail = ""
+    for block in iter(lambda: file.read(block_size), ""):
+        text = tail + block
+        start = 0
+        for match in SENTENCE_END_RE.finditer(text):
+            if match.end() == len(text):
+                # quotes or newlines may continue in the next block
+                break
+            yield text[start:match.end()]
+            start = match.end()
+        tail = text[start:]
+        if len(tail) > block_size:
+            # no sentence boundary in sight, don't let the tail grow unbounded
+            yield tail
+            tail = ""
+    if tail:
+        yield tail
+
+
+def iter_text_chunks(file, max_tokens=1000):
+    """
+    Group the sentences of a text file into chunks of at most max_tokens
+    (a single longer sentence becomes its own chunk). Chunks end at a
+    paragraph break when the chunk contains one.
+    """
+    return group_sentences(iter_sentences(file), max_tokens)
+
+
+def group_sentences(sentences, max_tokens):
+    chunk, tokens, paragraph_end = [], 0, 0
+    for sentence in sentences:
+        size = estimate_tokens(sentence)
+        if chunk and tokens + size > max_tokens:
+            cut = paragraph_end or len(chunk)
+            yield "".join(chunk[:cut])
+            chunk = chunk[cut:]
+            tokens = sum(estimate_tokens(s) for s in chunk)
+            paragraph_end = 0
+        chunk.append(sentence)
+        tokens += size
+        if sentence.endswith("\n"):
+            paragraph_end = len(chunk)
+    if chunk:
+        yield "".join(chunk)
+
+
+def split_sentences(text):
+    # Sentences of a string, joining them reproduces the string
+    sentences, start = [], 0
+    for match in SENTENCE_END_RE.finditer(text):
+        sentences.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+def split_by_tokens(text, max_tokens):
+    """
+    Split text at sentence boundaries into pieces of at most max_tokens.
+    Sentences longer than that are halved at commas.
+    """
+    pieces = []
+    for piece in group_sentences(split_sentences(text), max_tokens):
+        halves = halve(piece) if estimate_tokens(piece) > max_tokens else None
+        if halves:
+            pieces += split_by_tokens(halves[0], max_tokens) + split_by_tokens(halves[1], max_tokens)
+        else:
+            pieces.append(piece)
+    return pieces
+
+
+MIN_PIECE_TOKENS = 50  # halving below this rarely fixes a translation
+
+
+def halve(text):
+    """
+    Split text in two at the sentence boundary closest to its middle, or at
+    a comma if it is a single sentence. Returns None for text too short to
+    be worth splitting.
+    """
+    total = estimate_tokens(text)
+    if total < 2 * MIN_PIECE_TOKENS:
+        return None
+    boundaries = [match.end() for match in SENTENCE_END_RE.finditer(text) if match.end() < len(text)]
+    if not boundaries:
+        boundaries = [match.end() for match in re.finditer(r"[、，,；;：:]+", text) if match.end() < len(text)]
+    if not boundaries:
+        boundaries = [len(text) // 2]
+    middle = len(text) / 2
+    cut = min(boundaries, key=lambda i: abs(i - middle))
+    return text[:cut], text[cut:]
+
+
+def keep_whitespace(source, translated):
+    # Surround the translation with the whitespace around the source, e.g. paragraph breaks
+    leading = source[:len(source) - len(source.lstrip())]
+    trailing = source[len(source.rstrip()):]
+    return leading + translated.strip() + trailing
+
+
 def sep():
     return BeautifulSoup("<hr>", "html.parser")
 
@@ -230,13 +395,90 @@ def has_repeated_chars(line):
     return bool(re.search(pattern, line))
 
 
+def char_class(char):
+    if "\u3040" <= char <= "\u30FF" and char != "\u30FB":
+        return "K"  # kana (the katakana middle dot is punctuation)
+    if "\u4E00" <= char <= "\u9FFF":
+        return "H"  # han
+    if char.isascii() and char.isalpha():
+        return "L"  # latin
+    if "\u0400" <= char <= "\u04FF":
+        return "C"  # cyrillic
+    if char.isspace():
+        return "S"
+    if char.isdigit():
+        return "D"
+    if char.isalnum():
+        return "O"  # other letters, e.g. accented latin or hangul
+    return "P"  # punctuation and symbols
+
+
+class CharClassTable(dict):
+    # str.translate table mapping every character to its class, filled on first use
+    def __missing__(self, codepoint):
+        self[codepoint] = char_class(chr(codepoint))
+        return self[codepoint]
+
+
+CHAR_CLASSES = CharClassTable()
+
+
+class CharStats:
+    """Character class histogram of a text, see char_stats."""
+
+    def __init__(self, text=""):
+        classes = text.translate(CHAR_CLASSES)
+        self.length = len(text)
+        self.kana = classes.count("K")
+        self.han = classes.count("H")
+        self.latin = classes.count("L")
+        self.cyrillic = classes.count("C")
+        self.space = classes.count("S")
+        self.digit = classes.count("D")
+        self.other = classes.count("O")
+        self.punctuation = classes.count("P")
+
+    def __add__(self, other):
+        total = CharStats()
+        for key, value in vars(self).items():
+            setattr(total, key, value + getattr(other, key))
+        return total
+
+    @property
+    def letters(self):
+        return self.kana + self.han + self.latin + self.cyrillic + self.other
+
+    @property
+    def alnum(self):
+        return self.letters + self.digit
+
+    def language(self):
+        # Same thresholds as detect_language, over letters and digits
+        if self.alnum == 0:
+            return "Indeterminate"
+        if self.kana / self.alnum > 0.3:
+            return "Japanese"
+        elif self.latin / self.alnum > 0.7:
+            return "English"
+        else:
+            return "Chinese"
+
+
+def char_stats(text):
+    """
+    Return the CharStats of a text. One str.translate pass classifies every
+    character; callers that need several checks on a segment compute it once
+    and pass it along.
+    """
+    return CharStats(text)
+
+
 def check_jp(text, percentage=0.3):
     """Return True if over 30% of the chars in the text are hiragana and katakana, False otherwise."""
-    total_chars = len(text)
-    hiragana_katakana_chars = sum(1 for char in text if is_jp(char))
-    if total_chars == 0:
+    stats = char_stats(text)
+    if stats.length == 0:
         return False
-    return (hiragana_katakana_chars / total_chars) > percentage
+    return (stats.kana / stats.length) > percentage
 
 
 def is_jp(char):
@@ -311,11 +553,11 @@ def replace_repeater_char(text):
 
 
 def has_kana(text):
-    return bool(re.search(r"[\u3040-\u309F\u30A0-\u30FA\u30FC-\u30FF]+", text))
+    return char_stats(text).kana > 0
 
 
 def has_chinese(text):
-    return bool(re.search(r"[\u4E00-\u9FFF]+", text))
+    return char_stats(text).han > 0
 
 
 def remove_duplicate(text):
@@ -388,42 +630,58 @@ def remove_header(text):
 
 
 def detect_language(text):
-    # Counters for Japanese and English characters
-    hiragana_count = 0
-    katakana_count = 0
-    english_count = 0
-
-    # Removing non-word characters
-    cleaned_text = "".join(e for e in text if e.isalnum())
-
-    # Total characters (excluding special characters and punctuation)
-    total_characters = len(cleaned_text)
-
-    # Check for empty string
-    if total_characters == 0:
-        return "Indeterminate"
-
-    # Calculate counts of each character type
-    for char in cleaned_text:
-        # Checking Unicode ranges for Hiragana, Katakana, and English
-        if "\u3040" <= char <= "\u309F":
-            hiragana_count += 1
-        elif "\u30A0" <= char <= "\u30FF":
-            katakana_count += 1
-        elif ("\u0041" <= char <= "\u005A") or ("\u0061" <= char <= "\u007A"):
-            english_count += 1
-
-    # Calculate character type ratios
-    japanese_ratio = (hiragana_count + katakana_count) / total_characters
-    english_ratio = english_count / total_characters
-
-    # Apply the given conditions
-    if japanese_ratio > 0.3:
-        return "Japanese"
-    elif english_ratio > 0.7:
-        return "English"
-    else:
-        return "Chinese"
+    return char_stats(text).language()
+
+
+def is_trivial(text, stats=None):
+    # Fewer than two non-digit characters, or a link
+    text = text.strip()
+    if stats is None:
+        stats = char_stats(text)
+    return stats.length - stats.digit < 2 or text.startswith("http")
+
+
+def is_passthrough(text, language, stats=None, kana_nearby=True):
+    """
+    Return True if the segment needs no translation, given the language
+    detect_language found for its chapter. stats are the CharStats of the
+    stripped text, if already known. kana_nearby tells whether any kana
+    appears in the chapter or block around the segment.
+    """
+    text = text.strip()
+    if stats is None:
+        stats = char_stats(text)
+    if is_trivial(text, stats):
+        return True
+    # Ornaments, punctuation and numbers only, e.g. "◇◇◇" or "＊＊＊"
+    if stats.letters == 0:
+        return True
+    if stats.kana:
+        return False
+    if not stats.han:
+        # Latin credits and notes in a Japanese chapter
+        return language == "Japanese"
+    # Already Chinese. A kanji-only line next to any kana is as likely
+    # Japanese, e.g. a heading or a name, and is translated.
+    return stats.language() == "Chinese" and not kana_nearby
+
+
+def passthrough_segments(texts):
+    """
+    Mark the segments of a chapter that are kept as they are instead of being
+    sent to the model. The chapter's language comes from the summed
+    character statistics of its segments.
+    """
+    stats = [char_stats(text.strip()) for text in texts]
+    total = sum(stats, CharStats())
+    language = total.language()
+    if language == "Chinese" and total.kana:
+        # Kanji-heavy Japanese, such as a list of titles
+        language = "Japanese"
+    return [
+        is_passthrough(text, language, text_stats, kana_nearby=total.kana > 0)
+        for text, text_stats in zip(texts, stats)
+    ]
 
 
 def replace_section_titles(nested_list, title_buffer, cnjp=False):
@@ -439,7 +697,74 @@ def replace_section_titles(nested_list, title_buffer, cnjp=False):
     return nested_list
 
 
-def update_content(item, new_book, title_buffer, updated_content):
+class TitleReplacer:
+    """
+    Aho-Corasick automaton built once from a {jp_title: cn_title} mapping.
+    replace() rewrites a whole document in one linear pass, taking the
+    leftmost match and the longest title at that position.
+    """
+
+    def __init__(self, titles):
+        self.titles = {jp: cn for jp, cn in titles.items() if jp}
+        self.goto = [{}]
+        self.fail = [0]
+        self.length = [0]   # length of the title ending at each state, 0 if none
+        self.output = [0]   # nearest state on the fail chain that ends a title
+
+        for jp in self.titles:
+            state = 0
+            for char in jp:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.length.append(0)
+                    self.output.append(0)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.length[state] = len(jp)
+
+        # breadth-first construction of the failure links
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                link = self.fail[child]
+                self.output[child] = link if self.length[link] else self.output[link]
+                queue.append(child)
+
+    def replace(self, text):
+        if not self.titles:
+            return text
+
+        longest = {}  # start position -> length of the longest title there
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            match = state if self.length[state] else self.output[state]
+            while match:
+                start = i + 1 - self.length[match]
+                if self.length[match] > longest.get(start, 0):
+                    longest[start] = self.length[match]
+                match = self.output[match]
+
+        parts, last = [], 0
+        for start in sorted(longest):
+            if start < last:
+                continue
+            end = start + longest[start]
+            parts.append(text[last:start])
+            parts.append(self.titles[text[start:end]])
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
+
+
+def update_content(item, new_book, title_map, updated_content):
     if type(updated_content) is str:
         soup = BeautifulSoup(updated_content, "html5lib")
     else:
@@ -448,8 +773,8 @@ def update_content(item, new_book, title_buffer, updated_content):
 
     for a_tag in soup.find_all("a"):
         jp_text = a_tag.get_text()
-        if jp_text in title_buffer:
-            a_tag.string = title_buffer[jp_text]
+        if jp_text in title_map:
+            a_tag.string = title_map[jp_text]
 
     modified_item = deepcopy(item)
     modified_item.set_content(soup.encode("utf-8"))
@@ -717,81 +1042,169 @@ def remove_common_suffix(s1, s2):
     return s1, s2
 
 
-def wrap_text(html_content: str) -> str:
+NO_WRAP_TAGS = {"head", "title", "meta", "link", "script", "style", "noscript"}
+RAW_TEXT_TAGS = {"script", "style"}
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr",
+}
+
+
+class TextWrapper(HTMLParser):
     """
-    1) Unwrap <span> so that only text remains.
-    2) Flatten <ruby>...</ruby> by concatenating the 'base text' plus the last <rt>.
-    3) Merge consecutive text nodes (soup.smooth()), so adjacent text is combined.
-    4) Finally wrap each textual segment in <span class="temp">, 
-       except for those inside <head>, <title>, <meta>, <link>, <script>, <style>, etc.
+    Streaming transformer behind wrap_text. Tokens are rewritten as they are
+    read, so the chapter is never materialized as a tree:
+
+    - <span> tags are dropped and only their text is kept,
+    - <ruby> is reduced to its base text, and the readings from its <rt>
+      tags are recorded in `readings` (base text -> reading),
+    - adjacent text is merged and wrapped in <span class="temp">, except
+      inside NO_WRAP_TAGS.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-
-    # 1) Unwrap all <span> so only text remains
-    for tag in soup.find_all("span"):
-        # Replace the entire <span> with its textual content
-        tag.replace_with(tag.get_text())
-
-    # 2) Flatten <ruby> by concatenating the base text + the last <rt>
-    #    Example: <ruby>梶<rt>かじ</rt>原<rt>わら</rt>一<rt>いつ</rt>騎<rt>き</rt></ruby>
-    #    becomes "梶原一騎き"
-    for ruby_tag in soup.find_all("ruby"):
-        base_text_parts = []
-        last_rt_text = ""
-        # Iterate over children in order
-        for child in ruby_tag.children:
-            if child.name == "rt":
-                # update last rt text
-                if child.string:
-                    last_rt_text = child.string.strip()
-            elif isinstance(child, NavigableString):
-                # accumulate any plain text outside <rt>
-                base_text_parts.append(child.strip())
-
-        base_text = "".join(base_text_parts)
-        flattened = base_text + last_rt_text  # e.g., "梶原一騎" + "き" = "梶原一騎き"
-        # Replace the <ruby> element with the flattened text
-        ruby_tag.replace_with(flattened)
-
-    # 3) Merge consecutive text nodes so we don’t wrap them separately
-    #    Beautiful Soup's .smooth() merges adjacent NavigableString siblings into one
-    soup.smooth()
-
-    # 4) Wrap all remaining text nodes (that aren’t whitespace or comments)
-    #    in <span class="temp">, skipping forbidden parent tags
-    no_wrap_tags = {"head", "title", "meta", "link", "script", "style", "noscript"}
-
-    for text_node in soup.find_all(string=True):
-        # Skip empty or whitespace
-        if not text_node.strip():
-            continue
-        # Skip comments
-        if isinstance(text_node, Comment):
-            continue
-        # Skip if parent is one of the 'no_wrap_tags'
-        if text_node.parent and text_node.parent.name.lower() in no_wrap_tags:
-            continue
 
-        # At this point, we want to wrap the text node
-        new_span = soup.new_tag("span", attrs={"class": "temp"})
-        new_span.string = text_node
-        text_node.replace_with(new_span)
+    def __init__(self, readings=None):
+        super().__init__(convert_charrefs=True)
+        self.readings = readings
+        self.out = []
+        self.pending = []     # text waiting to be merged with its neighbours
+        self.open_tags = []   # open elements, excluding spans and ruby
+        self.span_depth = 0
+        self.ruby = None      # [base parts, rt parts, readings, depth] inside <ruby>
+
+    def flush(self):
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending = []
+        parent = self.open_tags[-1] if self.open_tags else None
+        if parent in RAW_TEXT_TAGS:
+            self.out.append(text)
+        elif text.strip() and parent not in NO_WRAP_TAGS:
+            self.out.append('<span class="temp">' + escape(text, quote=False) + "</span>")
+        else:
+            self.out.append(escape(text, quote=False))
+
+    def emit(self, markup):
+        self.flush()
+        self.out.append(markup)
+
+    def handle_starttag(self, tag, attrs):
+        if self.span_depth or tag == "span":
+            self.span_depth += tag == "span"
+            return
+        if self.ruby is not None:
+            self.ruby[3].append(tag)
+            if tag == "rt":
+                self.ruby[1] = []
+            return
+        if tag == "ruby":
+            self.ruby = [[], None, [], []]
+            return
+        self.emit(self.get_starttag_text())
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if self.span_depth or self.ruby is not None or tag == "span":
+            return
+        self.emit(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if self.span_depth:
+            self.span_depth -= tag == "span"
+            return
+        if self.ruby is not None:
+            depth = self.ruby[3]
+            if tag == "ruby" and not depth:
+                base, _, reading, _ = self.ruby
+                base, reading = "".join(base), "".join(reading)
+                self.ruby = None
+                self.pending.append(base)
+                if base and reading and self.readings is not None:
+                    self.readings[base] = reading
+            elif tag in depth:
+                while depth.pop() != tag:
+                    pass
+                if tag == "rt" and self.ruby[1] is not None:
+                    self.ruby[2].append("".join(self.ruby[1]).strip())
+                    self.ruby[1] = None
+            return
+        # Pending text belongs to the element being closed
+        self.flush()
+        if tag in self.open_tags:
+            while self.open_tags.pop() != tag:
+                pass
+        self.out.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if self.ruby is not None:
+            depth = self.ruby[3]
+            if not depth or depth[-1] == "rb":
+                self.ruby[0].append(data.strip())
+            elif depth[-1] == "rt" and self.ruby[1] is not None:
+                self.ruby[1].append(data)
+            return
+        self.pending.append(data)
+
+    def handle_comment(self, data):
+        if not (self.span_depth or self.ruby is not None):
+            self.emit(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self.emit(f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self.emit(f"<?{data}>")
+
+    def unknown_decl(self, data):
+        self.emit(f"<![{data}]>")
+
+    def transform(self, html_content):
+        self.feed(html_content)
+        self.close()
+        self.flush()
+        return "".join(self.out)
+
+
+def wrap_text(html_content: str, readings=None) -> str:
+    """
+    Unwrap <span>, reduce <ruby> to its base text and wrap each remaining
+    textual segment in <span class="temp">, in a single pass over the token
+    stream. See TextWrapper.
 
-    return str(soup)
+    If a dict is passed as `readings`, the furigana of every <ruby> is stored
+    in it as base text -> reading.
+    """
+    return TextWrapper(readings).transform(html_content)
+
+
+def ruby_hint(text, readings):
+    """
+    Return a compact furigana note for the ruby bases that occur in text,
+    e.g. "梶原（かじわら）", or "" if there are none.
+    """
+    if not readings:
+        return ""
+    return "、".join(f"{base}（{reading}）" for base, reading in readings.items() if base in text)
 
 
 def unwrap_text(html_content: str) -> str:
     """
-    Finds all <span class="temp"> ... </span> elements and unwraps them 
-    (removes the span, keeps the original text).
+    Removes all <span class="temp"> wrappers added by wrap_text, keeping the
+    original text.
+    """
+    return re.sub(r'<span class="temp">([^<]*)</span>', r"\1", html_content)
+
+
+def copy_soup(soup: BeautifulSoup) -> BeautifulSoup:
+    """
+    Copy a parsed document without serializing and parsing it again.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-    
-    # Find all <span class="temp"> elements
-    for temp_span in soup.find_all("span", class_="temp"):
-        temp_span.unwrap()
-    
-    return str(soup)
+    clone = BeautifulSoup("", "html5lib")
+    clone.clear()
+    for child in soup.contents:
+        clone.append(deepcopy(child))
+    return clone
 
 
 if __name__ == "__main__":
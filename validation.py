@@ -0,0 +1,75 @@
+from enum import Enum
+import re
+
+
+DEFAULT_PROMPT = "将下面的外文文本翻译为中文："
+REFUSALS = ["不需要翻译", "无需翻译"]
+READING_HINT = "注音："  # label of the furigana note put before the text
+TRUNCATED_FINISH_REASONS = {"length", "max_tokens"}
+REPETITION_RE = re.compile(r"(.{1,8}?)\1{9,}", re.S)
+
+
+class Reason(Enum):
+    OK = "ok"
+    API_ERROR = "api error"  # request failed or was blocked
+    REFUSED = "refused"  # model answered that no translation is needed
+    SOURCE_IS_LINK = "source is a link"
+    PROMPT_ECHO = "prompt echoed"
+    TRUNCATED = "truncated"  # output stopped at the token limit
+    REPETITION = "repetition"  # output stuck repeating a few characters
+    TOO_SHORT = "too short"  # translation far shorter than the source, likely omissions
+    TOO_LONG = "too long"  # translation far longer than the source, likely commentary
+
+
+class Action(Enum):
+    BACKOFF = "wait and resend"
+    LOWER_TEMPERATURE = "resend at a lower temperature"
+    STRICT_PROMPT = "resend with a trimmed, stricter prompt"
+    NEXT_MODEL = "move on to the next model"
+    SPLIT = "split the segment"
+
+
+# How translate() reacts to each failure. Only API errors wait: resending a
+# prompt the model already answered badly gains nothing from sleeping.
+RETRY_POLICY = {
+    Reason.API_ERROR: Action.BACKOFF,
+    Reason.REFUSED: Action.STRICT_PROMPT,
+    Reason.SOURCE_IS_LINK: Action.NEXT_MODEL,
+    Reason.PROMPT_ECHO: Action.STRICT_PROMPT,
+    Reason.TRUNCATED: Action.SPLIT,
+    Reason.REPETITION: Action.LOWER_TEMPERATURE,
+    Reason.TOO_SHORT: Action.STRICT_PROMPT,
+    Reason.TOO_LONG: Action.LOWER_TEMPERATURE,
+}
+
+
+def check_translation(jp_text, cn_text, finish_reason=None, prompts=(DEFAULT_PROMPT,)):
+    """
+    Return the Reason a translation is rejected, or Reason.OK.
+
+    finish_reason is the one reported with the response, if any. prompts
+    are the instructions that must not show up in the output.
+    """
+    if any(refusal in cn_text for refusal in REFUSALS):
+        return Reason.REFUSED
+    if jp_text.startswith("http"):
+        return Reason.SOURCE_IS_LINK
+    if any(prompt and prompt in cn_text for prompt in prompts):
+        return Reason.PROMPT_ECHO
+    if READING_HINT in cn_text and READING_HINT not in jp_text:
+        return Reason.PROMPT_ECHO
+    # A repetition loop usually runs into the token limit too, and needs a
+    # lower temperature rather than a split
+    if REPETITION_RE.search(cn_text) and not REPETITION_RE.search(jp_text):
+        return Reason.REPETITION
+    if finish_reason is not None and str(finish_reason).lower() in TRUNCATED_FINISH_REASONS:
+        return Reason.TRUNCATED
+    if len(cn_text) == 0:
+        return Reason.OK
+    # Ratio of source to translation length (avg 1.6)
+    ratio = len(jp_text.strip()) / max(len(cn_text.strip()), 1)
+    if ratio > 10:
+        return Reason.TOO_SHORT
+    if ratio < 0.5:
+        return Reason.TOO_LONG
+    return Reason.OK